@@ -0,0 +1,297 @@
+"""
+JSON API over the dashboard aggregates, for the tools that need the numbers without the page.
+
+    python api.py [--host 127.0.0.1] [--port 8502] [--workers N] [--engine cube]
+
+Endpoints (GET; filters as query parameters, named like the make_filters arguments: country,
+countries_compare (repeatable), region, regions_compare (repeatable), sesso, generazione, res_acq):
+
+- /options: values of the sidebar filters;
+- /stile: respondents per stile, one series per compared country/region (the stile chart);
+- /table?categories=regione&categories=sesso: the stile x category table (aggregate_dataframe);
+- /products?products=...: per product, the frequenza and cambiamento distributions and the gauge
+  values (mean volte al mese, growth rate in %); all the products by default;
+- /health: status and data version.
+
+The queries run in a process pool, through the same engines as dashboard.py. Responses are cached
+per data version and request (utils_cache.ResultCache) and carry an ETag derived from both, so
+clients revalidating with If-None-Match get a 304 until the data changes.
+"""
+import os
+import json
+import math
+import asyncio
+import hashlib
+import logging
+import argparse
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from utils_data import DATA_PATH, file_version
+from utils_agg import make_filters, filters_key
+from utils_cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = ['options', 'stile', 'table', 'products', 'health']
+CATEGORIES = ['regione', 'sesso', 'generazione']
+FILTER_PARAMS = ['country', 'region', 'sesso', 'generazione', 'res_acq']
+LIST_PARAMS = ['countries_compare', 'regions_compare', 'categories', 'products']
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+MAX_BODY = 64 * 1024  # bytes of a request body (read and ignored) above which the request is refused
+
+
+class RequestError(ValueError):
+    """Invalid request: answered with a 400 and the message."""
+
+
+def _number(value):
+    """A float for JSON: NaN and infinities (e.g. a growth rate with no decrease) become null."""
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def _counts(s):
+    return {str(label): int(count) for label, count in s.items()}
+
+
+#######################
+# Queries (run in the worker processes)
+_worker = {}
+
+
+def _init_worker(name, path):
+    from utils_engine import load_engine
+    _worker.update(name=name, path=path)
+    load_engine(name, path)
+
+
+def parse_params(query):
+    """
+    make_filters arguments and options of a query string.
+
+    :raise RequestError: on an unknown parameter or a repeated single value parameter.
+    """
+    params = parse_qs(query, keep_blank_values=False)
+    unknown = set(params) - set(FILTER_PARAMS) - set(LIST_PARAMS)
+    if unknown:
+        raise RequestError(f"unknown parameters: {sorted(unknown)}")
+    single = {}
+    for name in FILTER_PARAMS:
+        values = params.get(name, ['All'])
+        if len(values) > 1:
+            raise RequestError(f"{name} can be given once")
+        single[name] = values[0]
+    lists = {name: params.get(name, []) for name in LIST_PARAMS}
+    return single, lists
+
+
+def run_query(endpoint, single, lists):
+    """The response body (dict) of `endpoint` for the parsed parameters (see parse_params)."""
+    from utils_contstants import food
+    from utils_engine import load_engine
+    engine = load_engine(_worker['name'], _worker['path'])
+    if endpoint == 'options':
+        return {'options': engine.options}
+
+    for name, values in [('country', [single['country']] + lists['countries_compare']),
+                         ('regione', [single['region']] + lists['regions_compare']),
+                         ('sesso', [single['sesso']]), ('generazione', [single['generazione']]),
+                         ('res_acq', [single['res_acq']])]:
+        unknown = [value for value in values if value != 'All' and value not in engine.options[name]]
+        if unknown:
+            raise RequestError(f"unknown {name}: {unknown}")
+    filters, compare_by = make_filters(single['country'], lists['countries_compare'], single['region'],
+                                       lists['regions_compare'], single['sesso'], single['generazione'],
+                                       single['res_acq'])
+    body = {'filters': filters, 'compare_by': compare_by, 'rows': int(engine.n_rows(filters))}
+
+    if endpoint == 'stile':
+        if compare_by is None:
+            series_list = [engine.stile_counts(filters).rename('All')]
+        else:
+            # one row per compared country/region; the stili without respondents are left out, as
+            # in the series of a single location
+            matrix = engine.stile_matrix(filters, compare_by)
+            series_list = [row[row > 0].rename(name) for name, row in matrix.iterrows()]
+        body['series'] = [{'name': str(s.name), 'counts': _counts(s)} for s in series_list]
+    elif endpoint == 'table':
+        categories = lists['categories'] or CATEGORIES
+        if set(categories) - set(CATEGORIES):
+            raise RequestError(f"categories must be among {CATEGORIES}")
+        table = engine.category_table(filters, categories=categories)
+        body['table'] = {'index': [str(i) for i in table.index], 'columns': [str(c) for c in table.columns],
+                         'data': table.to_numpy().tolist()}
+    elif endpoint == 'products':
+        products = lists['products'] or list(food)
+        unknown = [product for product in products if product not in food]
+        if unknown:
+            raise RequestError(f"unknown products: {unknown}")
+        stats = engine.product_stats(filters)
+        body['products'] = {
+            product: {
+                'frequenza': _counts(stats['frequenza'][product]),
+                'cambiamento': _counts(stats['cambiamento'][product]),
+                'mean': _number(stats['mean'][product]),
+                'growth': _number(stats['growth'][product]),
+            }
+            for product in products
+        }
+    return body
+
+
+def compute_response(endpoint, single, lists):
+    """(status, JSON bytes) of a request, computed in a worker process."""
+    try:
+        body = run_query(endpoint, single, lists)
+        return 200, json.dumps(body, ensure_ascii=False).encode()
+    except RequestError as e:
+        return 400, json.dumps({'error': str(e)}).encode()
+
+
+#######################
+# Server
+class ApiServer:
+    """asyncio HTTP/1.1 server (keep-alive, GET only) answering from a process pool and a response cache."""
+
+    def __init__(self, name=None, path=DATA_PATH, workers=None, cache=None):
+        from utils_engine import ENGINE
+        self.name = name or ENGINE
+        self.path = os.path.abspath(path)
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache or ResultCache(max_entries=4096)
+        self.pool = None
+        self.requests = 0
+
+    def start_pool(self):
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.name, self.path))
+        # start the workers (and build their engine) before the first request
+        list(self.pool.map(abs, range(self.workers)))
+
+    def etag(self, version, key):
+        return '"' + hashlib.blake2b(repr((version, key)).encode(), digest_size=12).hexdigest() + '"'
+
+    async def respond(self, target, headers):
+        """(status, body bytes, extra headers) of a GET of `target`."""
+        url = urlsplit(target)
+        endpoint = url.path.strip('/')
+        if endpoint not in ENDPOINTS:
+            return 404, json.dumps({'error': f"unknown endpoint, expected one of {ENDPOINTS}"}).encode(), {}
+        version = file_version(self.path)
+        # the responses of the former data version are dropped as soon as a request sees the new one
+        self.cache.check_version(self.path, version)
+        if endpoint == 'health':
+            body = {'status': 'ok', 'engine': self.name, 'version': list(version), 'workers': self.workers,
+                    'requests': self.requests, 'cache': self.cache.stats()}
+            return 200, json.dumps(body).encode(), {}
+        try:
+            single, lists = parse_params(url.query)
+        except RequestError as e:
+            return 400, json.dumps({'error': str(e)}).encode(), {}
+
+        # canonical request: the same for the same filter state, whatever the order of the values
+        filters, compare_by = make_filters(single['country'], lists['countries_compare'], single['region'],
+                                           lists['regions_compare'], single['sesso'], single['generazione'],
+                                           single['res_acq'])
+        key = (endpoint, filters_key(filters), compare_by, tuple(lists['categories']),
+               tuple(sorted(set(lists['products']))))
+        etag = self.etag(version, key)
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            return 304, b'', {'ETag': etag}
+
+        loop = asyncio.get_running_loop()
+
+        def compute():
+            return self.pool.submit(compute_response, endpoint, single, lists).result()
+
+        status, body = await loop.run_in_executor(
+            None, self.cache.get_or_compute, (self.path, version) + key, compute)
+        return status, body, {'ETag': etag} if status == 200 else {}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                self.requests += 1
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if len(parts) != 3 or length < 0:
+                    # the end of the request is unknown: answer and close the connection
+                    await self.send(writer, 400, json.dumps({'error': 'malformed request'}).encode(), {}, False)
+                    break
+                if length > MAX_BODY:
+                    # not read: the connection is closed instead
+                    await self.send(writer, 413, json.dumps({'error': f'body over {MAX_BODY} bytes'}).encode(),
+                                    {}, False)
+                    break
+                method, target, version = parts
+                # the body is not used, but read: the next request of the connection starts after it
+                await reader.readexactly(length)
+                if method != 'GET':
+                    status, body, extra = 405, json.dumps({'error': 'only GET is supported'}).encode(), {}
+                else:
+                    try:
+                        status, body, extra = await self.respond(target, headers)
+                    except Exception:
+                        logger.exception("error answering %s", target)
+                        status, body, extra = 500, json.dumps({'error': 'internal error'}).encode(), {}
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                await self.send(writer, status, body, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # client gone, or gone in the middle of a body
+        finally:
+            writer.close()
+
+    async def send(self, writer, status, body, extra, keep_alive):
+        """Writes a response with the JSON `body` and the `extra` headers."""
+        head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json; charset=utf-8",
+                f"Content-Length: {len(body)}", "Cache-Control: no-cache",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head += [f"{name}: {value}" for name, value in extra.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8502):
+        self.start_pool()
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("serving %s (engine %s, %d workers) on %s:%d", self.path, self.name, self.workers, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=None, help="query processes (default: all the cores)")
+    parser.add_argument('--engine', default=None, help="engine (default: $STILI_ENGINE or cube)")
+    parser.add_argument('--path', default=DATA_PATH, help="csv file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    server = ApiServer(args.engine, args.path, args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Load test of api.py: starts the server in a subprocess, then runs --clients concurrent keep-alive
+clients for --seconds over a mix of requests and prints requests/s and latency percentiles as JSON.
+
+- hot: every client cycles through the same few requests (the response cache answers);
+- cold: the requests are the selections of utils_store.filter_space, each asked once (the worker
+  pool computes them);
+- revalidate: the hot requests with If-None-Match (304 answers).
+
+    python benchmarks/bench_api.py [--mix hot cold revalidate] [--clients 16] [--seconds 10] [--workers N]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+import subprocess
+import urllib.request
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HOT = [
+    '/stile',
+    '/stile?country=Italia&countries_compare=USA',
+    '/table?country=Italia',
+    '/products?country=Italia',
+    '/products?products=%E2%98%95%20caff%C3%A8',
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers, engine):
+    """api.py in a subprocess, once it answers /health."""
+    command = [sys.executable, os.path.join(ROOT, 'api.py'), '--port', str(port)]
+    if workers:
+        command += ['--workers', str(workers)]
+    if engine:
+        command += ['--engine', engine]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"api.py exited with {process.returncode}")
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1) as response:
+                return process, json.load(response)
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("api.py did not start")
+
+
+def cold_targets(port):
+    """One /stile, /table and /products request per selection of the filter space."""
+    from utils_store import filter_space
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/options') as response:
+        options = json.load(response)['options']
+    targets = []
+    for country, countries_compare, region, regions_compare, sesso, generazione, res_acq in filter_space(options):
+        query = urlencode({'country': country, 'countries_compare': countries_compare, 'region': region,
+                           'regions_compare': regions_compare, 'sesso': sesso, 'generazione': generazione,
+                           'res_acq': res_acq}, doseq=True)
+        targets += [f'/stile?{query}', f'/table?{query}', f'/products?{query}']
+    return targets
+
+
+async def fetch(reader, writer, target, etag=None):
+    """(status, ETag) of a GET on the keep-alive connection."""
+    head = f"GET {target} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+    if etag:
+        head += f"If-None-Match: {etag}\r\n"
+    writer.write((head + "\r\n").encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers.get('etag')
+
+
+async def client(port, mix, cold, seconds, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    etags = {}
+    deadline = time.perf_counter() + seconds
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            kind = mix[i % len(mix)]
+            if kind == 'cold':
+                if not cold:
+                    break
+                target = cold.pop()
+            else:
+                target = HOT[i % len(HOT)]
+            start = time.perf_counter()
+            status, etag = await fetch(reader, writer, target, etags.get(target) if kind == 'revalidate' else None)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if etag:
+                etags[target] = etag
+            i += 1
+    finally:
+        writer.close()
+
+
+async def load(port, mix, clients, seconds):
+    latencies, statuses = [], {}
+    cold = cold_targets(port) if 'cold' in mix else []
+    cold.reverse()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, mix, cold, seconds, latencies, statuses) for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2),
+        'p50_ms': percentile(0.50),
+        'p90_ms': percentile(0.90),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1] * 1000, 2),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', nargs='+', default=['hot', 'cold', 'revalidate'],
+                        choices=['hot', 'cold', 'revalidate'], help="kinds of requests, in turn")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=None, help="api.py query processes")
+    parser.add_argument('--engine', default=None)
+    args = parser.parse_args()
+
+    port = free_port()
+    process, health = start_server(port, args.workers, args.engine)
+    try:
+        report = {'engine': health['engine'], 'workers': health['workers'], 'clients': args.clients,
+                  'mix': args.mix}
+        report.update(asyncio.run(load(port, args.mix, args.clients, args.seconds)))
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/health') as response:
+            report['cache'] = json.load(response)['cache']
+    finally:
+        process.terminate()
+        process.wait()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of the comparison chart against the number of compared regions: from the engine query to
+the (series x stile) matrix of bar widths the renderers draw, through the list path (stile_counts_by,
+one Series per region with split_series, one reindex per Series) and the matrix path (stile_matrix,
+one dense crosstab reindexed once).
+
+The survey has a few Italian regions only: the rows are spread over --groups synthetic regions
+(random, fixed seed) so that 2 to 20 regions can be compared on the same data.
+
+    python benchmarks/bench_compare.py [--groups 2 5 10 20] [--repeat 20] [--render]
+
+With --render the matplotlib chart (PNG) of the matrix is timed too.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from utils_contstants import order_stile
+from utils_data import load_data
+from utils_agg import make_filters, split_series
+from utils_engine import ENGINES
+from utils_plot import bar_widths, bar_percentages, plot_horizontal_bar_chart, figure_to_bytes
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median_ms': round(statistics.median(times) * 1000, 3), 'min_ms': round(min(times) * 1000, 3)}
+
+
+def with_regions(df, n, seed=0):
+    """The survey with its rows spread over `n` regions named R01, R02, ..."""
+    names = np.array([f'R{i + 1:02d}' for i in range(n)])
+    regions = names[np.random.default_rng(seed).integers(0, n, len(df))]
+    return df.assign(country='Italia', regione=regions), list(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, nargs='+', default=[2, 5, 10, 20])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--render', action='store_true', help="also time the PNG chart of the matrix")
+    args = parser.parse_args()
+
+    df, names = with_regions(load_data(), max(args.groups))
+    engines = {name: build(df) for name, build in ENGINES.items()}
+    results = {}
+    for n in args.groups:
+        filters, compare_by = make_filters('Italia', region=names[0], regions_compare=names[1:n])
+
+        def list_path(engine):
+            series_list = split_series(engine.stile_counts_by(filters, compare_by))
+            return bar_percentages(bar_widths(series_list, order_stile))
+
+        def matrix_path(engine):
+            return bar_percentages(bar_widths(engine.stile_matrix(filters, compare_by), order_stile))
+
+        results[n] = {}
+        for name, engine in engines.items():
+            results[n][name] = {'list': timed(lambda: list_path(engine), args.repeat),
+                                'matrix': timed(lambda: matrix_path(engine), args.repeat)}
+        if args.render:
+            matrix = engines['cube'].stile_matrix(filters, compare_by)
+            results[n]['render_png'] = timed(lambda: figure_to_bytes(plot_horizontal_bar_chart(
+                matrix, order_stile, 'Stili alimentari', figsize=(10, 5))), max(1, args.repeat // 10))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
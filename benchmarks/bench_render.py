@@ -0,0 +1,78 @@
+"""
+Compares the chart backends of the dashboard: matplotlib (figure + PNG, like st.pyplot/st.image)
+and plotly for the gauges, against the Vega-Lite specs of utils_vega (dict + JSON, what
+st.vega_lite_chart sends to the browser). The render cache is bypassed.
+
+    python benchmarks/bench_render.py [--repeat 5]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def import_seconds(module):
+    """Import time of `module` in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout)
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median_ms': statistics.median(times) * 1000, 'min_ms': min(times) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from utils_contstants import food, order_stile, order_frequenza
+    from utils_engine import load_engine
+    from utils_agg import make_filters
+    from utils_plot import plot_horizontal_bar_chart, plot_gauge, figure_to_bytes, DEFAULT_THEME
+    from utils_vega import vega_horizontal_bar_chart, vega_gauge
+
+    engine = load_engine()
+    filters, compare_by = make_filters('Italia', ['USA', 'Francia', 'Germania'])
+    # one row per compared country, like dashboard.py
+    matrix = engine.stile_matrix(filters, compare_by)
+    all_filters, _ = make_filters()
+    charts = {
+        'stile': ([engine.stile_counts(all_filters)], order_stile, dict(figsize=(10, 5), show_legend=False)),
+        'stile_compare': (matrix, order_stile, dict(figsize=(10, 5), labels=list(matrix.index))),
+        'frequenza': (engine.answer_counts(all_filters, [food[p][0] for p in list(food)[:3]]), order_frequenza,
+                      dict(figsize=(6, 3), labels=list(food)[:3])),
+    }
+
+    results = {'imports_s': {module: import_seconds(module)
+                             for module in ('matplotlib.pyplot', 'plotly.graph_objects', 'utils_vega')}}
+    for name, (series_list, order, kwargs) in charts.items():
+        results[name] = {
+            'matplotlib': timed(lambda: figure_to_bytes(
+                plot_horizontal_bar_chart(series_list, order, name, **kwargs)), args.repeat),
+            'vega': timed(lambda: json.dumps(vega_horizontal_bar_chart(
+                series_list, order, name, colors=DEFAULT_THEME.colors, **kwargs)), args.repeat),
+        }
+    results['gauge'] = {
+        'plotly': timed(lambda: plot_gauge(3.2, DEFAULT_THEME.colors[0]).to_json(), args.repeat),
+        'vega': timed(lambda: json.dumps(vega_gauge(3.2, DEFAULT_THEME.colors[0])), args.repeat),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Load test of dashboard.py: simulated users driving the page through Streamlit's testing API
+(streamlit.testing.v1.AppTest), for every concurrency level of --users.
+
+At each level, --workers processes are started fresh (cold caches and an empty result store,
+like new Streamlit server processes after a first deploy) and share the users, which run as
+concurrent sessions on threads of their worker.
+Each user loads the page, then makes --steps random changes, each followed by the rerun of the
+page: a country, countries to compare, an Italian region, regions to compare, sesso,
+generazione, res_acq, the color theme, the products or the table categories. --think seconds
+pass between two changes (0: every user reruns as fast as the worker answers).
+
+    python benchmarks/bench_sessions.py [--users 1 2 4 8] [--workers 1] [--steps 10] [--cache on off]
+
+Prints, per cache mode and level, the rerun latency percentiles (p50/p95/p99, first page loads
+apart), the reruns/s, the CPU (% of one core) and peak RSS of every worker and the hit rates of
+the result and render caches and of the result store shared by the workers, as JSON.
+`saturation_users` is the first level whose throughput is less than 10% above the previous
+one: more users only wait longer from there. With --cache off the workers run with the result
+and render caches and the result store disabled, to see what caching saves under contention.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DASHBOARD = os.path.join(ROOT, 'dashboard.py')
+
+# (action, weight): how often the users make each kind of change
+ACTIONS = [('country', 3), ('compare_countries', 2), ('region', 2), ('compare_regions', 1), ('sesso', 2),
+           ('generazione', 2), ('res_acq', 1), ('theme', 1), ('products', 3), ('categories', 1)]
+SELECTBOXES = {
+    'country': 'Selezionare un paese',
+    'region': 'Selezionare una regione',
+    'sesso': 'Selezionare un sesso',
+    'generazione': 'Selezionare una generazione',
+    'res_acq': 'Selezionare responsabili acquisti',
+    'theme': '🎨 Select a color theme',
+}
+
+
+def change(at, action, rng):
+    """
+    Applies a random change of kind `action` to the widgets of the page `at`, if the page has the
+    widget (e.g. the regions only show up for Italia). Returns whether something changed.
+    """
+    if action in SELECTBOXES:
+        widgets = [w for w in at.sidebar.selectbox if w.label == SELECTBOXES[action]]
+        if not widgets:
+            return False
+        widgets[0].select(rng.choice(widgets[0].options))
+        return True
+    if action in ('compare_countries', 'compare_regions'):
+        # the countries' Compare: comes first, the regions' one only when a region is selected
+        widgets = [w for w in at.sidebar.multiselect if w.label == 'Compare:']
+        i = 0 if action == 'compare_countries' else 1
+        if len(widgets) <= i:
+            return False
+        options = widgets[i].options
+        widgets[i].set_value(rng.sample(options, rng.randint(0, min(2, len(options)))))
+        return True
+    # main panel: the table categories, then the products
+    widget = at.main.multiselect[0 if action == 'categories' else 1]
+    widget.set_value(rng.sample(widget.options, rng.randint(1, 3 if action == 'products' else 2)))
+    return True
+
+
+def user(at, rng, steps, think, records):
+    """One simulated session: the first load, then `steps` changes, each rerun timed."""
+    actions, weights = zip(*ACTIONS)
+    start = time.perf_counter()
+    at.run()
+    records.append(('first', time.perf_counter() - start, len(at.exception)))
+    for _ in range(steps):
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+        while not change(at, rng.choices(actions, weights)[0], rng):
+            pass
+        start = time.perf_counter()
+        try:
+            at.run()
+            errors = len(at.exception)
+        except Exception:  # timeout of the script run
+            errors = 1
+        records.append(('rerun', time.perf_counter() - start, errors))
+
+
+def worker(index, users, steps, think, seed, cache, barrier, results):
+    """A worker process: `users` sessions on threads, started together with the other workers."""
+    import logging
+    import threading
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    # the warnings of the script runs (e.g. the empty multiselect labels), once per rerun
+    logging.disable(logging.WARNING)
+    from streamlit.testing.v1 import AppTest
+    from utils_data import rss_bytes
+    from utils_cache import result_cache
+    from utils_plot import render_cache
+    import utils_store
+    if not cache:
+        result_cache.max_entries = 0
+        render_cache.max_bytes = 0
+        # open_store() answers None: the dashboard runs without the store
+        utils_store._stores[utils_store.store_path()] = None
+
+    store = utils_store.open_store(create=True)
+    sessions = [AppTest.from_file(DASHBOARD, default_timeout=600) for _ in range(users)]
+    records = []
+    rss = {'start': rss_bytes(), 'peak': rss_bytes()}
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.05):
+            rss['peak'] = max(rss['peak'], rss_bytes())
+
+    barrier.wait()
+    cpu, wall = time.process_time(), time.perf_counter()
+    threads = [threading.Thread(target=user, args=(at, random.Random(f'{seed}/{index}/{i}'), steps, think, records))
+               for i, at in enumerate(sessions)]
+    threads.append(threading.Thread(target=sample_rss))
+    for thread in threads:
+        thread.start()
+    for thread in threads[:-1]:
+        thread.join()
+    done.set()
+    threads[-1].join()
+    results.put({
+        'worker': index,
+        'users': users,
+        'records': records,
+        'seconds': time.perf_counter() - wall,
+        'cpu_seconds': time.process_time() - cpu,
+        'rss_start_bytes': rss['start'],
+        'rss_peak_bytes': rss['peak'],
+        'result_cache': result_cache.stats(),
+        'render_cache': render_cache.stats(),
+        'result_store': store.stats()['process'] if store is not None else None,
+    })
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def p(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1)
+
+    return {'p50_ms': p(0.50), 'p95_ms': p(0.95), 'p99_ms': p(0.99), 'max_ms': round(values[-1] * 1000, 1),
+            'mean_ms': round(statistics.mean(values) * 1000, 1)}
+
+
+def run_level(users, workers, steps, think, seed, cache):
+    """Report of one concurrency level: `users` sessions over `workers` fresh processes."""
+    context = multiprocessing.get_context('spawn')
+    workers = min(workers, users)
+    barrier, results = context.Barrier(workers), context.Queue()
+    shares = [users // workers + (i < users % workers) for i in range(workers)]
+    processes = [context.Process(target=worker, args=(i, share, steps, think, seed, cache, barrier, results))
+                 for i, share in enumerate(shares)]
+    with tempfile.TemporaryDirectory() as store:
+        os.environ['STILI_STORE_DIR'] = store  # inherited by the workers
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    reruns = [seconds for report in reports for kind, seconds, _ in report['records'] if kind == 'rerun']
+    first = [seconds for report in reports for kind, seconds, _ in report['records'] if kind == 'first']
+    seconds = max(report['seconds'] for report in reports)
+    return {
+        'users': users,
+        'workers': workers,
+        'reruns': len(reruns),
+        'errors': sum(errors for report in reports for _, _, errors in report['records']),
+        'seconds': round(seconds, 2),
+        'reruns_per_second': round((len(reruns) + len(first)) / seconds, 2),
+        'rerun': percentiles(reruns),
+        'first_load': percentiles(first),
+        'per_worker': [{
+            'users': report['users'],
+            'cpu_percent': round(report['cpu_seconds'] / report['seconds'] * 100, 1),
+            'rss_start_mb': round(report['rss_start_bytes'] / 2**20, 1),
+            'rss_peak_mb': round(report['rss_peak_bytes'] / 2**20, 1),
+            'result_cache_hit_rate': round(report['result_cache']['hit_rate'], 3),
+            'result_cache_waits': report['result_cache']['waits'],
+            'render_cache_hit_rate': round(report['render_cache']['hits'] / max(
+                1, report['render_cache']['hits'] + report['render_cache']['misses']), 3),
+            'result_store_hit_rate': round(report['result_store']['hit_rate'], 3) if report['result_store'] else None,
+        } for report in sorted(reports, key=lambda report: report['worker'])],
+    }
+
+
+def saturation(levels, gain=0.10):
+    """Users of the first level whose throughput is less than `gain` above the previous level's."""
+    for previous, level in zip(levels, levels[1:]):
+        if level['reruns_per_second'] < previous['reruns_per_second'] * (1 + gain):
+            return level['users']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 2, 4, 8], help="concurrency levels")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes sharing the users")
+    parser.add_argument('--steps', type=int, default=10, help="changes made by every user")
+    parser.add_argument('--think', type=float, default=0.0, help="mean seconds between two changes of a user")
+    parser.add_argument('--cache', nargs='+', choices=['on', 'off'], default=['on'])
+    parser.add_argument('--renderer', choices=['matplotlib', 'vega'], default=None,
+                        help="STILI_RENDERER of the workers (default: the environment's)")
+    parser.add_argument('--seed', default='0')
+    args = parser.parse_args()
+    if args.renderer:
+        os.environ['STILI_RENDERER'] = args.renderer  # inherited by the workers
+
+    report = {'cpu_count': os.cpu_count(), 'workers': args.workers, 'steps': args.steps, 'think': args.think,
+              'renderer': os.environ.get('STILI_RENDERER', 'matplotlib'), 'modes': {}}
+    for mode in args.cache:
+        levels = []
+        for users in args.users:
+            levels.append(run_level(users, args.workers, args.steps, args.think, args.seed, mode == 'on'))
+            print(f"cache {mode}, {users} users: {levels[-1]['reruns_per_second']} reruns/s, "
+                  f"p95 {levels[-1]['rerun'].get('p95_ms')} ms", file=sys.stderr, flush=True)
+        report['modes'][mode] = {'saturation_users': saturation(levels), 'levels': levels}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Per-stage timings and peak memory of the code paths of dashboard.py, without a browser:
+
+- load: CSV read + rename/normalize (utils_data.read_survey);
+- build_<engine>: construction of the query engines (utils_engine.ENGINES, and from the csv for
+  utils_engine.STREAMED_ENGINES; for duckdb, writing its Parquet copy of the csv and opening it);
+- for every filter selection of the matrix, on the pandas path (utils_agg over the DataFrame):
+  filter (make_filters + filter_df), group (group_df_all, or stile_matrix when comparing),
+  aggregate (aggregate_dataframe), products (product_stats: answers, means and growth rates of
+  every product in `food`), render (plot_horizontal_bar_chart to PNG of the stile chart and of the
+  frequenza of 3 products, plot_gauge to JSON), and query_<engine>: the queries of a full rerun
+  of dashboard.py (stile_counts or stile_matrix, category_table, product_stats) on each engine.
+
+The data is the survey resampled (with replacement, fixed seed) to 1x, 10x, 100x its rows and
+written as CSV in --workdir (kept between runs). Timings are the median/min over --repeat runs;
+peak memory is the tracemalloc peak of one extra run.
+
+    python benchmarks/bench_stages.py [--scales 1 10 100] [--out results.json]
+    python benchmarks/bench_stages.py --scales 1 100 --engines pandas duckdb   # SQL against pandas
+    python benchmarks/bench_stages.py --baseline results.json [--tolerance 0.25]
+
+With --baseline the stages slower than baseline * (1 + tolerance) are listed under "regressions"
+and the exit status is 1.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+from utils_contstants import food, order_stile, order_frequenza
+from utils_data import DATA_PATH, read_survey
+from utils_agg import (make_filters, filter_options, filter_df, group_df_all, stile_matrix, aggregate_dataframe,
+                       product_stats)
+from utils_engine import ENGINES, STREAMED_ENGINES
+from utils_duck import DuckEngine, build_parquet, available as duckdb_available
+from utils_plot import plot_horizontal_bar_chart, plot_gauge, figure_to_bytes, DEFAULT_THEME
+
+
+def scaled_csv(scale, workdir, seed=0):
+    """The survey csv with `scale` times its rows, resampled with replacement."""
+    if scale == 1:
+        return DATA_PATH
+    path = os.path.join(workdir, f'stili_al_x{scale}.csv')
+    if not os.path.exists(path):
+        raw = pd.read_csv(DATA_PATH, dtype=str, keep_default_na=False)
+        rows = np.random.default_rng(seed).integers(0, len(raw), len(raw) * scale)
+        raw.iloc[rows].to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def selections(options):
+    """Matrix of sidebar selections, from the values found in the data."""
+    countries, regions = options['country'], options['regione']
+    return {
+        'all': make_filters(),
+        'country': make_filters(countries[0]),
+        'compare_countries': make_filters(countries[0], countries[1:4]),
+        'region': make_filters('Italia', region=regions[0]),
+        'compare_regions': make_filters('Italia', region=regions[0], regions_compare=regions[1:3]),
+        'narrow': make_filters('Italia', sesso=options['sesso'][0], generazione=options['generazione'][0],
+                               res_acq=options['res_acq'][0]),
+    }
+
+
+def measure(fn, repeat):
+    """Median/min time of `fn` over `repeat` runs, then the tracemalloc peak of one more run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'median_ms': round(statistics.median(times) * 1000, 3), 'min_ms': round(min(times) * 1000, 3),
+            'peak_bytes': peak}
+
+
+def selection_stages(df, filters, compare_by, engines, repeat):
+    filtered = filter_df(df, filters)
+
+    def group():
+        # the data of the stile chart, like dashboard.py: one series, or one matrix row per compared group
+        return stile_matrix(filtered, compare_by) if compare_by else group_df_all(filtered, 'stile')
+
+    stile = group()
+    products = list(food)[:3]
+    frequenza = [product_stats(filtered)['frequenza'][product] for product in products]
+
+    def render():
+        if compare_by:
+            figure_to_bytes(plot_horizontal_bar_chart(stile, order_stile, 'Stili alimentari', figsize=(10, 5),
+                                                      labels=list(stile.index)))
+        else:
+            figure_to_bytes(plot_horizontal_bar_chart([stile], order_stile, 'Stili alimentari', figsize=(10, 5)))
+        figure_to_bytes(plot_horizontal_bar_chart(frequenza, order_frequenza, 'Frequenza', figsize=(6, 3),
+                                                  labels=products))
+        plot_gauge(3.2, DEFAULT_THEME.colors[0]).to_json()
+
+    def query(engine):
+        def run():
+            engine.stile_matrix(filters, compare_by) if compare_by else engine.stile_counts(filters)
+            engine.category_table(filters)
+            engine.product_stats(filters)
+        return run
+
+    stages = {
+        'rows': len(filtered),
+        'filter': measure(lambda: filter_df(df, filters), repeat),
+        'group': measure(group, repeat),
+        'aggregate': measure(lambda: aggregate_dataframe(filtered), repeat),
+        'products': measure(lambda: product_stats(filtered), repeat),
+        'render': measure(render, repeat),
+    }
+    for name, engine in engines.items():
+        stages[f'query_{name}'] = measure(query(engine), repeat)
+    return stages
+
+
+def run(scales, engine_names, repeat, workdir):
+    results = {
+        'meta': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                 'machine': platform.machine(), 'repeat': repeat},
+        'scales': {},
+    }
+    for scale in scales:
+        path = scaled_csv(scale, workdir)
+        # big inputs are not re-read --repeat times
+        stages = {'load': measure(lambda: read_survey(path), 1 if scale >= 10 else repeat)}
+        df = read_survey(path)
+        engines = {}
+        for name in engine_names:
+            if name == 'duckdb':
+                # the Parquet copy is reused while the csv does not change: time writing it too
+                def build():
+                    build_parquet(path)
+                    return DuckEngine(path)
+            elif name in STREAMED_ENGINES:
+                # built from the csv in chunks: compare its peak memory with load + build_cube
+                def build():
+                    return STREAMED_ENGINES[name](path)
+            else:
+                def build():
+                    return ENGINES[name](df)
+            stages[f'build_{name}'] = measure(build, 1 if scale >= 10 else repeat)
+            engines[name] = build()
+        selection_results = {
+            selection: selection_stages(df, filters, compare_by, engines, repeat)
+            for selection, (filters, compare_by) in selections(filter_options(df)).items()
+        }
+        results['scales'][str(scale)] = {'rows': len(df), 'stages': stages, 'selections': selection_results}
+        print(f"x{scale}: {len(df)} rows done", file=sys.stderr)
+    return results
+
+
+def flatten(results):
+    """{'<scale>/<stage>' or '<scale>/<selection>/<stage>': median_ms}."""
+    timings = {}
+    for scale, scale_results in results['scales'].items():
+        for stage, value in scale_results['stages'].items():
+            timings[f'{scale}/{stage}'] = value['median_ms']
+        for selection, stages in scale_results['selections'].items():
+            for stage, value in stages.items():
+                if isinstance(value, dict):
+                    timings[f'{scale}/{selection}/{stage}'] = value['median_ms']
+    return timings
+
+
+def compare(results, baseline, tolerance, min_ms=1.0):
+    """
+    Stages slower than in `baseline` by more than `tolerance` (a fraction). Timings under `min_ms`
+    in both runs are left out: at that size the noise is larger than the differences.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    regressions, improvements = {}, {}
+    for key, ms in current.items():
+        before = previous.get(key)
+        if before is None or max(ms, before) < min_ms:
+            continue
+        ratio = ms / before if before else float('inf')
+        entry = {'baseline_ms': before, 'median_ms': ms, 'ratio': round(ratio, 3)}
+        if ratio > 1 + tolerance:
+            regressions[key] = entry
+        elif ratio < 1 / (1 + tolerance):
+            improvements[key] = entry
+    return {'tolerance': tolerance, 'regressions': regressions, 'improvements': improvements,
+            'missing': sorted(set(previous) - set(current))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES) + list(STREAMED_ENGINES),
+                        default=[name for name in list(ENGINES) + list(STREAMED_ENGINES)
+                                 if name != 'duckdb' or duckdb_available()])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'stili_bench'),
+                        help='where the scaled csv files are written')
+    parser.add_argument('--out', help='write the results to this file (default: stdout)')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run(args.scales, args.engines, args.repeat, args.workdir)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['comparison'] = compare(results, json.load(f), args.tolerance)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.baseline and results['comparison']['regressions']:
+        for key, entry in results['comparison']['regressions'].items():
+            print(f"regression {key}: {entry['baseline_ms']} -> {entry['median_ms']} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Concurrency stress test of the chart rendering: many threads render bar charts with different
+themes at the same time (like sessions picking different color themes on one Streamlit worker)
+and every image must be byte-identical to the one rendered alone, single-threaded, for the same
+inputs and theme.
+
+    python benchmarks/stress_theme.py [--threads 16] [--renders 200] [--seed 0]
+
+Prints the number of renders, mismatches and renders/s as JSON; the exit status is 1 on any
+mismatch.
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import matplotlib
+matplotlib.use('Agg')
+from utils_contstants import COLORS, food, order_stile, order_frequenza
+from utils_agg import make_filters
+from utils_engine import load_engine
+from utils_plot import (DEFAULT_THEME, plot_horizontal_bar_chart, plot_vertical_bar_chart, figure_to_bytes,
+                        render_horizontal_bar_chart, render_cache)
+
+
+def charts():
+    """(name, render(theme) -> PNG bytes) of a few charts of the dashboard."""
+    engine = load_engine()
+    filters, compare_by = make_filters('Italia', ['USA', 'Francia'])
+    stile = engine.stile_matrix(filters, compare_by)
+    stats = engine.product_stats(make_filters('Italia')[0])
+    products = list(food)[:3]
+    frequenza = [stats['frequenza'][product] for product in products]
+    return [
+        ('stile', lambda theme: figure_to_bytes(plot_horizontal_bar_chart(
+            stile, order_stile, 'Stili alimentari', figsize=(10, 5), labels=list(stile.index), theme=theme))),
+        ('frequenza', lambda theme: figure_to_bytes(plot_horizontal_bar_chart(
+            frequenza, order_frequenza, 'Frequenza', figsize=(6, 3), labels=products, theme=theme))),
+        ('frequenza_vertical', lambda theme: figure_to_bytes(plot_vertical_bar_chart(
+            frequenza, order_frequenza, 'Frequenza', labels=products, theme=theme))),
+        ('frequenza_cached', lambda theme: render_horizontal_bar_chart(
+            frequenza, order_frequenza, 'Frequenza', figsize=(6, 3), labels=products, theme=theme)),
+    ]
+
+
+def digest(image):
+    return hashlib.blake2b(image, digest_size=16).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--renders', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # one theme per color of the sidebar picker
+    themes = [DEFAULT_THEME.with_first(color) for color in COLORS]
+    chart_list = charts()
+    expected = {(name, theme): digest(render(theme)) for name, render in chart_list for theme in themes}
+    render_cache.clear()
+
+    rng = random.Random(args.seed)
+    jobs = [(rng.choice(chart_list), rng.choice(themes)) for _ in range(args.renders)]
+
+    def run(job):
+        (name, render), theme = job
+        return name, theme, digest(render(theme))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        results = list(pool.map(run, jobs))
+    seconds = time.perf_counter() - start
+
+    mismatches = [{'chart': name, 'theme': list(theme.colors)} for name, theme, result in results
+                  if result != expected[(name, theme)]]
+    report = {
+        'threads': args.threads,
+        'renders': len(results),
+        'themes': len(themes),
+        'mismatches': len(mismatches),
+        'seconds': round(seconds, 2),
+        'renders_per_second': round(len(results) / seconds, 1),
+        'render_cache': render_cache.stats(),
+        'first_mismatches': mismatches[:5],
+    }
+    print(json.dumps(report, indent=2))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
+import os
 import streamlit as st
-import pandas as pd
-import numpy as np
-import altair as alt
-import plotly.graph_objects as go
-import plotly.express as px
-import matplotlib.pyplot as plt
-from utils_contstants import *
-from utils_plot import plot_vertical_bar_chart, plot_horizontal_bar_chart, plot_gauge, colors
+from utils_contstants import BLUE, CYAN, GREEN, YELLOW, RED, OLIVE, PURPLE, GOLD
+from utils_contstants import food, order_stile, order_frequenza, order_cambiamento
+from utils_plot import render_horizontal_bar_chart, render_gauge, DEFAULT_THEME
+from utils_vega import vega_horizontal_bar_chart, vega_gauge
+from utils_engine import CachedEngine
+from utils_store import open_store
+from utils_agg import make_filters
+from utils_perf import RerunTrace, stage_metrics
 
 #######################
 # Page configuration
@@ -17,83 +18,141 @@ st.set_page_config(
     initial_sidebar_state='expanded'
 )
 
-alt.themes.enable('dark')
+# timing spans of the stages of this rerun (utils_perf); ?debug=1 shows them in the sidebar
+trace = RerunTrace()
+DEBUG = bool(st.query_params.get('debug'))
 
 #######################
-# Load Data
-df = pd.read_csv('data/stili_al.csv')
-df = (df
-    .rename(columns={'area': 'regione', 's3': 'sesso', 'generation': 'generazione'})
-    .replace('Nessuno di questi', 'Nessuno stile')
-)
+# Load Data (engine built once per process and data version, query results shared by all the
+# sessions of the process, see utils_engine.CachedEngine, and read from and written to the
+# on-disk store shared by the workers of the machine, pre-filled by `python utils_store.py warm`)
+with trace.span('load'):
+    store = open_store(create=True)
+    engine = CachedEngine(store=store)
+    options = engine.options
+
+# charts backend: 'matplotlib' (PNG rendered on the server) or 'vega' (Vega-Lite specs drawn by the browser)
+RENDERER = os.environ.get('STILI_RENDERER', 'matplotlib')
 
 checkpoint_countries = []
 checkpoint_regions = []
+selected_region = 'All'
+
+
+#######################
+# Charts
+def show_bar_chart(run, series_list, order, title, theme=DEFAULT_THEME, **kwargs):
+    """Draws a bar chart, its stages timed in the trace `run`."""
+    if RENDERER == 'vega':
+        with run.span('render'):
+            spec = vega_horizontal_bar_chart(series_list, order, title, colors=theme.colors, **kwargs)
+        with run.span('serialize'):
+            st.vega_lite_chart(spec, width='stretch')
+    else:
+        with run.span('render'):
+            image = render_horizontal_bar_chart(series_list, order, title, store=store, theme=theme, **kwargs)
+        with run.span('serialize'):
+            st.image(image, width='stretch')
+
+
+def show_gauge(run, value, color, **kwargs):
+    with run.span('gauge'):
+        if RENDERER == 'vega':
+            st.vega_lite_chart(vega_gauge(value, color, **kwargs))
+        else:
+            st.plotly_chart(render_gauge(value, color, **kwargs))
+
 
 #######################
-# Grouping function
-def group_df_all(df, metric: str) -> pd.Series:
-    # group for a bar chart
-    s = (df
-            .groupby(metric)
-            .count()
-        ).country.sort_values()
-    return s    
-
-
-def group_df(df, metric: str, compare_by: str) -> pd.Series:
-    # group for a bar chart
-    s = (df
-            .groupby([compare_by, metric])
-            .country
-            .count()
-            #.sort_values()
-        )
-    return s
-
-
-def aggregate_dataframe(df, stile_col='stile', categories=['regione', 'gender', 'generazione']):
+# Fragments: the table and the product panel rerun alone when their own widgets change, on the
+# filters of the last full rerun (their inputs); the sidebar reruns the whole page
+def fragment_trace(name):
     """
-    Aggregates a DataFrame by a 'stile' column and counts occurrences of specified categories.
-    
-    Parameters:
-    - df: DataFrame to be processed.
-    - stile_col: The name of the column to group by. Default is 'stile'.
-    - categories: List of column names to count occurrences for. Default is ['regione', 'gender', 'generazione'].
-    
-    Returns:
-    - A new DataFrame with the total count and counts for specified categories by 'stile'.
+    The trace of the stages of a fragment: the page's one during a full rerun, a new one when the
+    fragment reruns alone, measured against the last full rerun.
     """
-    # Filter DataFrame to include only relevant columns (stile + categories)
-    relevant_df = df[[stile_col] + categories]
-    
-    # Calculate the total counts for each 'stile'
-    total_counts = relevant_df.groupby(stile_col).size().rename('Total')
-    
-    # Initialize a list to hold the data for each category
-    category_data = []
-    
-    # Process each category
-    for category in categories:
-        # Create dummy variables for the current category
-        dummies = pd.get_dummies(relevant_df[[stile_col, category]], columns=[category])
-        # Aggregate dummies by 'stile'
-        aggregated = dummies.groupby(stile_col).sum()
-        # Rename columns to include category name
-        aggregated.columns = [col.split("_")[-1] for col in aggregated.columns]
-        # Append to the list
-        category_data.append(aggregated)
+    if trace.total_ms is None:
+        return trace
+    return RerunTrace(f'dashboard/{name}', baseline_ms=trace.total_ms)
+
+
+def end_fragment(run, filters):
+    if run is not trace:
+        run.filters = filters
+        run.finish()
+        if DEBUG:
+            st.caption(f"⏱ {run.page}: {run.total_ms:.0f} ms instead of {run.baseline_ms:.0f} ms")
+
+
+@st.fragment
+def show_category_table(filters):
+    run = fragment_trace('table')
+    selected_categories = st.multiselect('', ['regione', 'sesso', 'generazione'], placeholder="Choose a category")
+    with run.span('aggregate'):
+        af = engine.category_table(filters, categories=selected_categories or ['regione', 'sesso', 'generazione'])
+
+    st.dataframe(af,
+                 column_config={
+                     "Total": st.column_config.ProgressColumn(
+                         "Total",
+                         format="%f",
+                         min_value=0,
+                         max_value=max(af.Total)
+                     )
+                 }
+                 )
+    end_fragment(run, filters)
+
+
+@st.fragment
+def show_product_panel(filters, theme):
+    run = fragment_trace('products')
+    st.markdown('#### Prodotti')
+    selected_food = st.multiselect('', food.keys(), placeholder="Selezionare un prodotto")
+    if not selected_food:
+        selected_food = ['🧁 pasticceria']
+
+    # answer counts, means and growth rates of all the products at once
+    with run.span('answers'):
+        stats = engine.product_stats(filters)
+
+    #subcol = st.columns((1, 1), gap='medium')
+    #with subcol[0]:
+    series_list = [stats['frequenza'][prodotto] for prodotto in selected_food]
+    order = order_frequenza
+    #st.dataframe(series_list[0])
+    show_bar_chart(run, series_list, order, title="Frequenza", labels=selected_food, figsize=(6, 3), theme=theme)
+
+    ##### Gauge Chart
+    freq_dict = {prodotto: round(stats['mean'][prodotto], 1) for prodotto in selected_food}
     
-    # Combine all the category data with the total counts
-    summary_df = pd.concat([total_counts] + category_data, axis=1).fillna(0).astype(int)
+    col_maker = [1 for item in selected_food]
+    subcol = st.columns(col_maker)
+
+    for i, prodotto in enumerate(selected_food):
+        with subcol[i]:
+            show_gauge(run, freq_dict[selected_food[i]], theme.colors[i])
 
-    summary_df=summary_df.sort_values('Total', ascending=False)  # sort by total
-    if 'Altro, non vuole indicare' in summary_df.columns:
-        del summary_df['Altro, non vuole indicare']
 
-    #summary_df['stile'] = pd.Categorical(summary_df['stile'], categories=order_stile, ordered=True)
 
-    return summary_df
+
+    #with subcol[1]:
+    series_list = [stats['cambiamento'][prodotto] for prodotto in selected_food]
+    order = order_cambiamento
+    show_bar_chart(run, series_list, order, title="Cambiamento", labels=selected_food, figsize=(6,3), theme=theme)
+    #st.image('images/cioccolato.png')
+
+    ##### Gauge Chart: Cambiamento
+    freq_dict = {prodotto: stats['growth'][prodotto] for prodotto in selected_food}
+    
+    col_maker = [1 for item in selected_food]
+    subcol = st.columns(col_maker)
+
+    for i, prodotto in enumerate(selected_food):
+        with subcol[i]:
+            show_gauge(run, freq_dict[selected_food[i]], theme.colors[i], 
+                       title="Growth Rate", limit_down=-100, limit_up=100, perc=True)
+    end_fragment(run, filters)
 
 
 #######################
@@ -103,52 +162,39 @@ col = st.columns((2, 1), gap='medium')
 ############# Sidebar
 with st.sidebar:
     st.title('🥑 Stili alimentari')
-    countries = ['All'] + list(df.country.unique())
+    countries = ['All'] + options['country']
     selected_country = st.selectbox('Selezionare un paese', countries)
 
-    if selected_country == 'All':
-        df_filtered = df
-    else:
-        df_filtered = df.query('country == @selected_country')
-
+    if selected_country != 'All':
         # compare with another country
-        countries_compare = [country for country in list(df.country.unique()) if country != selected_country]
+        countries_compare = [country for country in options['country'] if country != selected_country]
         checkpoint_countries = st.multiselect('Compare:', countries_compare)
-        if checkpoint_countries: # if there are selected countries to compare
-            selected_countries = [selected_country] + checkpoint_countries
-            df_filtered = df.query('country in @selected_countries')
-            
+
         # region
         if selected_country == "Italia":
-            regions = ['All'] + list(df_filtered.query("country == 'Italia'").regione.unique())
+            regions = ['All'] + options['regione']
             selected_region = st.selectbox('Selezionare una regione', regions)
             if selected_region != 'All':
-                df_filtered = df_filtered.query('regione == @selected_region')
-
-                # compare with another country
-                regions_compare = [region for region in list(df.query("country == 'Italia'").regione.unique()) if region != selected_region]
+                # compare with another region
+                regions_compare = [region for region in options['regione'] if region != selected_region]
                 checkpoint_regions = st.multiselect('Compare:', regions_compare)
-                if checkpoint_regions: # if there are selected regions to compare
-                    selected_regions = [selected_region] + checkpoint_regions
-                    df_filtered = df.query('regione in @selected_regions')
 
     # gender
-    genders = ['All'] + list(df.sesso.unique())
+    genders = ['All'] + options['sesso']
     selected_gender = st.selectbox('Selezionare un sesso', genders)
-    if selected_gender != 'All':
-        df_filtered = df_filtered.query('sesso == @selected_gender')
 
     # age group
-    ages = ['All'] + list(  np.sort(df.generazione.unique() ))
+    ages = ['All'] + sorted(options['generazione'])
     selected_age = st.selectbox('Selezionare una generazione', ages)
-    if selected_age != 'All':
-        df_filtered = df_filtered.query('generazione == @selected_age')
-    
+
     # s5
-    s5_list = ['All'] + list(df.res_acq.unique())
+    s5_list = ['All'] + options['res_acq']
     selected_s5 = st.selectbox('Selezionare responsabili acquisti', s5_list)
-    if selected_s5 != 'All':
-        df_filtered = df_filtered.query('res_acq == @selected_s5')
+
+    with trace.span('filter'):
+        filters, compare_by = make_filters(selected_country, checkpoint_countries, selected_region,
+                                           checkpoint_regions, selected_gender, selected_age, selected_s5)
+    trace.filters = filters
 
     # Color theme
     st.markdown("""<br><hr>""", unsafe_allow_html=True) # a gap br and a line (hr)
@@ -164,10 +210,8 @@ with st.sidebar:
         'purple': PURPLE,
         'gold': GOLD
     }
-    selected_color = color_map[selected_color_theme]
-    if selected_color in colors:
-        colors.remove(selected_color)  # Remove the selected_color from its current position
-        colors.insert(0, selected_color) 
+    # colors of this session's charts (a new theme per rerun: the default one is shared)
+    theme = DEFAULT_THEME.with_first(color_map[selected_color_theme])
 
 
 
@@ -177,119 +221,46 @@ with col[0]:
     st.markdown('#### Stili Alimentari')
     
     # The Bar Chart
-    if selected_country == "All":
-        metric_series = group_df_all(df_filtered, "stile")
+    if compare_by is None:
+        with trace.span('group'):
+            metric_series = engine.stile_counts(filters)
         #st.dataframe(metric_series)
         #fig = make_bars_plotly_all(selected_color_theme, metric_series, fixed_order_flag_freq=False)
-        fig = plot_horizontal_bar_chart([metric_series], order=order_stile, title='Stili alimentari', 
-                                        show_legend=False, show_title=False, figsize=(10, 5))
+        show_bar_chart(trace, [metric_series], order=order_stile, title='Stili alimentari', 
+                       show_legend=False, show_title=False, figsize=(10, 5), theme=theme)
     else:
-        if checkpoint_regions:
-            metric_series = group_df(df_filtered, "stile", 'regione')
-            series_list = []
-            for area, group in metric_series.groupby(level=0):
-                series = group.reset_index(level=0, drop=True)
-                series.name = area  # Set the series name to the country
-                series_list.append(series)
-        else:
-            metric_series = group_df(df_filtered, "stile", 'country')
-            # Create a list of Series
-            series_list = []
-            for country, group in metric_series.groupby(level=0):
-                series = group.reset_index(level=0, drop=True)
-                series.name = country  # Set the series name to the country
-                series_list.append(series)
+        with trace.span('group'):
+            # one row per country (or region), one column per stile
+            matrix = engine.stile_matrix(filters, compare_by)
 
-        #st.dataframe(metric_series)
+        #st.dataframe(matrix)
         #fig = make_bars_plotly(selected_color_theme, metric_series)
-        fig = plot_horizontal_bar_chart(series_list, order=order_stile, title='Stili alimentari', show_title=False,
-                                        labels=[ser.name for ser in series_list], figsize=(10, 5))
+        show_bar_chart(trace, matrix, order=order_stile, title='Stili alimentari', show_title=False,
+                       labels=list(matrix.index), figsize=(10, 5), theme=theme)
     #st.plotly_chart(fig)
-    st.pyplot(fig)
 
     # ##### TABLE
-    selected_categories = st.multiselect('', ['regione', 'sesso', 'generazione'], placeholder="Choose a category")
-    af = aggregate_dataframe(df_filtered, categories=['regione', 'sesso', 'generazione'])
-    if selected_categories:
-        af = aggregate_dataframe(df_filtered, categories=selected_categories)
-  
-    st.dataframe(af,
-                 column_config={
-                     "Total": st.column_config.ProgressColumn(
-                         "Total",
-                         format="%f",
-                         min_value=0,
-                         max_value=max(af.Total)
-                     )
-                 }
-                 )
-
-
-
-
+    show_category_table(filters)
 
 
 ################################# COLUMN 2
 with col[1]:
-    st.markdown('#### Prodotti')
-    selected_food = st.multiselect('', food.keys(), placeholder="Selezionare un prodotto")
-    if not selected_food:
-        selected_food = ['🧁 pasticceria']
+    show_product_panel(filters, theme)
 
-    df_prodotti = df_filtered[[ food[prodotto][0] for prodotto in selected_food ] + [ food[prodotto][1] for prodotto in selected_food ]]
-    #st.text(df_prodotti)
 
-    #subcol = st.columns((1, 1), gap='medium')
-    #with subcol[0]:
-    temp_df = df_filtered[[food[prodotto][0] for prodotto in selected_food ]]
-    series_list = []
-    for col in temp_df.columns:
-        series_list.append(temp_df[col].value_counts())
-    order = order_frequenza
-    #st.dataframe(series_list[0])
-    fig = plot_horizontal_bar_chart(series_list, order, title="Frequenza", labels=selected_food, figsize=(6, 3))
-    st.pyplot(fig)
-
-    ##### Gauge Chart
-    df_prodotti = df_filtered[[ food[prodotto][2] for prodotto in selected_food ]]
-    freq_dict = {selected_food[i]: round(df_prodotti[col].mean(), 1) for i, col in enumerate(df_prodotti) }
-    
-    col_maker = [1 for item in selected_food]
-    subcol = st.columns(col_maker)
-
-    for i, prodotto in enumerate(selected_food):
-        with subcol[i]:
-            fig = plot_gauge(freq_dict[selected_food[i]], colors[i])
-            st.plotly_chart(fig)
-
-
-
-
-    #with subcol[1]:
-    temp_df = df_filtered[[food[prodotto][1] for prodotto in selected_food ]]
-    series_list = []
-    for col in temp_df.columns:
-        series_list.append(temp_df[col].value_counts())
-    order = order_cambiamento
-    fig = plot_horizontal_bar_chart(series_list, order, title="Cambiamento", labels=selected_food, figsize=(6,3))
-    st.pyplot(fig)
-    #st.image('images/cioccolato.png')
-
-    ##### Gauge Chart: Cambiamento
-    df_prodotti = df_filtered[[ food[prodotto][3] for prodotto in selected_food ]]
-    freq_dict = {selected_food[i]: 
-                 ((df_prodotti.loc[df[col]==1][col].sum() / -df_prodotti.loc[df[col]==-1][col].sum() ) - 1 )*100
-                 for i, col in enumerate(df_prodotti) }
-    
-    col_maker = [1 for item in selected_food]
-    subcol = st.columns(col_maker)
-
-    for i, prodotto in enumerate(selected_food):
-        with subcol[i]:
-            fig = plot_gauge(freq_dict[selected_food[i]], colors[i], 
-                             title="Growth Rate", limit_down=-100, limit_up=100, perc=True)
-            st.plotly_chart(fig)
-
-
-
-    
+#######################
+# Performance debug panel (hidden: open the page with ?debug=1)
+trace.finish()
+if DEBUG:
+    with st.sidebar.expander('⏱ Performance', expanded=True):
+        st.caption(f"rerun: {trace.total_ms:.1f} ms")
+        st.dataframe([{'stage': stage, 'calls': entry['calls'], 'ms': round(entry['ms'], 2),
+                       'rss delta MB': round(entry['rss_delta_bytes'] / 2**20, 2)}
+                      for stage, entry in trace.stages().items()], hide_index=True)
+        st.caption("filters")
+        st.json(trace.filters, expanded=False)
+        st.caption(f"process: {stage_metrics.reruns} reruns, full and partial (saved: vs a full rerun)")
+        st.dataframe([dict(page=page, **entry) for page, entry in stage_metrics.pages_table().items()],
+                     hide_index=True)
+        st.dataframe([dict(stage=stage, **entry) for stage, entry in stage_metrics.table().items()],
+                     hide_index=True)
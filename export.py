@@ -0,0 +1,216 @@
+"""
+Report pack: every chart of the dashboard for every location, rendered ahead of time to files.
+
+    python export.py [--out report] [--formats png svg] [--workers N] [--engine cube]
+
+For all the countries together, each country and each Italian region, writes to --out/<location>/:
+
+- stile.<fmt>: the stile chart;
+- <product>_frequenza.<fmt>, <product>_cambiamento.<fmt>: the bar charts of every product in `food`;
+- <product>_volte_al_mese.<fmt>, <product>_growth_rate.<fmt>: its gauges (as .html when plotly
+  cannot export images, i.e. kaleido is not installed);
+- numbers.csv: the numbers behind the charts (view, product, label, value).
+
+The locations are rendered over a process pool. The content key of every file (utils_plot.chart_key
+/ gauge_key, hash of the csv) is kept in --out/manifest.json: files whose key did not change are
+not rendered again, so a new pack after a data update only redraws what the new data changed.
+Progress is printed on stderr as the locations complete, then a JSON report on stdout.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import importlib.util
+from utils_data import DATA_PATH, atomic_write
+
+logger = logging.getLogger(__name__)
+
+GAUGES = {
+    'volte_al_mese': dict(title="Volte al mese"),
+    'growth_rate': dict(title="Growth Rate", limit_down=-100, limit_up=100, perc=True),
+}
+
+
+def slug(name):
+    """File name of a location or product: the words of `name` (emojis dropped) joined by '_'."""
+    return re.sub(r'\W+', '_', name).strip('_')
+
+
+def locations(options):
+    """(folder, make_filters arguments) of every location of the pack."""
+    items = [('Tutti', ())]
+    items += [(slug(country), (country,)) for country in options['country']]
+    items += [(slug(f'Italia {region}'), ('Italia', (), region)) for region in options['regione']]
+    return items
+
+
+#######################
+# Rendering (in the worker processes)
+_worker = {}
+
+
+def _init_worker(name, path, out, formats):
+    import matplotlib
+    matplotlib.use('Agg')
+    from utils_engine import load_engine
+    _worker.update(engine=load_engine(name, path), out=out, formats=formats,
+                   kaleido=importlib.util.find_spec('kaleido') is not None)
+
+
+def _numbers_csv(location, stile, stats):
+    import pandas as pd
+    from utils_contstants import food
+    # stile: [Series] of a location, or the matrix of compared ones (one row each)
+    series_list = [row for _, row in stile.iterrows()] if isinstance(stile, pd.DataFrame) else stile
+    rows = [('stile', '', label, value) for series in series_list for label, value in series.items()]
+    for product in food:
+        rows += [('frequenza', product, label, value) for label, value in stats['frequenza'][product].items()]
+        rows += [('cambiamento', product, label, value) for label, value in stats['cambiamento'][product].items()]
+        rows += [('mean', product, '', stats['mean'][product]), ('growth', product, '', stats['growth'][product])]
+    frame = pd.DataFrame(rows, columns=['view', 'product', 'label', 'value'])
+    frame.insert(0, 'location', location)
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False)
+    return buffer.getvalue().encode()
+
+
+def _export_location(folder, selection, previous):
+    """
+    Renders the files of one location whose key is not the one in `previous` ({file: key}).
+
+    :return: ({file: key} of the location, files written, files skipped).
+    """
+    from utils_contstants import food, order_stile, order_frequenza, order_cambiamento
+    from utils_agg import make_filters
+    from utils_plot import plot_horizontal_bar_chart, plot_gauge, figure_to_bytes, chart_key, gauge_key, DEFAULT_THEME
+    engine, formats = _worker['engine'], _worker['formats']
+    directory = os.path.join(_worker['out'], folder)
+    os.makedirs(directory, exist_ok=True)
+
+    filters, compare_by = make_filters(*selection)
+    # like dashboard.py: one series, or one matrix row per compared country/region
+    stile = (engine.stile_matrix(filters, compare_by) if compare_by
+             else [engine.stile_counts(filters).rename('Tutti')])
+    stile_labels = list(stile.index) if compare_by else ['Tutti']
+    stats = engine.product_stats(filters)
+
+    # (file, key, render() -> bytes) of every output of the location
+    outputs = []
+    for fmt in formats:
+        bars = [('stile', stile, order_stile, 'Stili alimentari',
+                 dict(labels=stile_labels, figsize=(10, 5)))]
+        for product in food:
+            bars.append((f'{slug(product)}_frequenza', [stats['frequenza'][product]], order_frequenza,
+                         f'Frequenza - {product}', dict(labels=[product], show_legend=False, figsize=(6, 3))))
+            bars.append((f'{slug(product)}_cambiamento', [stats['cambiamento'][product]], order_cambiamento,
+                         f'Cambiamento - {product}', dict(labels=[product], show_legend=False, figsize=(6, 3))))
+        for name, series_list, order, title, kwargs in bars:
+            outputs.append((f'{name}.{fmt}', chart_key(series_list, order, title, fmt=fmt, **kwargs),
+                            lambda s=series_list, o=order, t=title, k=kwargs, f=fmt:
+                            figure_to_bytes(plot_horizontal_bar_chart(s, o, t, **k), f)))
+
+        gauge_fmt = fmt if _worker['kaleido'] else 'html'
+        color = DEFAULT_THEME.colors[0]
+        for product in food:
+            values = {'volte_al_mese': round(stats['mean'][product], 1), 'growth_rate': stats['growth'][product]}
+            for name, kwargs in GAUGES.items():
+                file = f'{slug(product)}_{name}.{gauge_fmt}'
+                if any(file == output[0] for output in outputs):
+                    continue  # without kaleido, png and svg share the html gauge
+                value = values[name]
+                outputs.append((file, gauge_key(value, color, fmt=gauge_fmt, **kwargs),
+                                lambda v=value, k=kwargs, f=gauge_fmt: _gauge_bytes(plot_gauge(v, color, **k), f)))
+
+    csv = _numbers_csv(folder, stile, stats)
+    outputs.append(('numbers.csv', hashlib.blake2b(csv, digest_size=16).hexdigest(), lambda: csv))
+
+    keys, written, skipped = {}, 0, 0
+    for file, key, render in outputs:
+        path = os.path.join(directory, file)
+        keys[file] = key
+        if previous.get(file) == key and os.path.exists(path):
+            skipped += 1
+            continue
+        atomic_write(path, render())
+        written += 1
+    return keys, written, skipped
+
+
+def _gauge_bytes(fig, fmt):
+    if fmt == 'html':
+        return fig.to_html(include_plotlyjs='cdn', full_html=True).encode()
+    return fig.to_image(format=fmt)
+
+
+#######################
+# Pack
+def export(out='report', name=None, path=DATA_PATH, formats=('png',), workers=None, progress=None):
+    """
+    Writes the report pack of the survey csv at `path` to `out`, over a pool of `workers`
+    processes (default: all the cores).
+
+    :param progress: Optional callable(location, done, total) called as the locations complete.
+    :return: Report with the number of locations, files written and skipped, time and throughput.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from utils_engine import ENGINE, load_engine
+    name = name or ENGINE
+    path = os.path.abspath(path)
+    os.makedirs(out, exist_ok=True)
+    manifest_path = os.path.join(out, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    start = time.perf_counter()
+    items = locations(load_engine(name, path).options)
+    workers = workers or os.cpu_count() or 1
+    written = skipped = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(name, path, out, list(formats))) as pool:
+        futures = {pool.submit(_export_location, folder, selection, manifest.get(folder, {})): folder
+                   for folder, selection in items}
+        for done, future in enumerate(as_completed(futures), 1):
+            keys, location_written, location_skipped = future.result()
+            manifest[futures[future]] = keys
+            written += location_written
+            skipped += location_skipped
+            if progress is not None:
+                progress(futures[future], done, len(items))
+    atomic_write(manifest_path, json.dumps(manifest, indent=1, ensure_ascii=False).encode())
+    seconds = time.perf_counter() - start
+    report = {
+        'out': os.path.abspath(out),
+        'engine': name,
+        'workers': workers,
+        'locations': len(items),
+        'files_written': written,
+        'files_skipped': skipped,
+        'seconds': round(seconds, 2),
+        'files_per_second': round((written + skipped) / seconds, 1),
+    }
+    logger.info("exported %d locations to %s in %.1f s", len(items), out, seconds)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='report', help="output directory")
+    parser.add_argument('--formats', nargs='+', choices=['png', 'svg'], default=['png'])
+    parser.add_argument('--path', default=DATA_PATH, help="csv file")
+    parser.add_argument('--engine', default=None, help="engine computing the numbers (default: $STILI_ENGINE)")
+    parser.add_argument('--workers', type=int, default=None, help="processes (default: all the cores)")
+    args = parser.parse_args()
+
+    def progress(location, done, total):
+        print(f"[{done}/{total}] {location}", file=sys.stderr, flush=True)
+
+    report = export(args.out, args.engine, args.path, args.formats, args.workers, progress=progress)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import asyncio
+from utils_data import DATA_PATH, file_version
+from api import ApiServer, MAX_BODY
+
+
+async def exchange(data, responses):
+    """Sends `data` on one connection to an ApiServer and reads `responses` responses (status, headers, body)."""
+    server = ApiServer(workers=1)
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        await writer.drain()
+        results = []
+        for _ in range(responses):
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while (line := await reader.readline()) != b'\r\n':
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers['content-length']))
+            results.append((status, headers, json.loads(body)))
+        rest = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+    return results, rest
+
+
+def test_pipelined_request_after_a_body():
+    data = (b'POST /health HTTP/1.1\r\nContent-Length: 11\r\n\r\n{"a": "b"}\n'
+            b'GET /health HTTP/1.1\r\nConnection: close\r\n\r\n')
+    (first, second), rest = asyncio.run(exchange(data, 2))
+    assert first[0] == 405
+    assert first[1]['connection'] == 'keep-alive'
+    assert second[0] == 200 and second[2]['status'] == 'ok'
+    assert rest == b''
+
+
+def test_malformed_request_line():
+    (response,), rest = asyncio.run(exchange(b'GARBAGE\r\n\r\nGET /health HTTP/1.1\r\n\r\n', 1))
+    assert response[0] == 400
+    assert response[1]['connection'] == 'close'
+    assert rest == b''  # closed, the rest of the input is not answered
+
+
+def test_invalid_content_length():
+    (response,), rest = asyncio.run(exchange(b'GET /health HTTP/1.1\r\nContent-Length: x\r\n\r\n', 1))
+    assert response[0] == 400
+    assert rest == b''
+
+
+def test_body_over_the_limit():
+    data = b'POST /health HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (MAX_BODY + 1)
+    (response,), rest = asyncio.run(exchange(data, 1))
+    assert response[0] == 413
+    assert response[1]['connection'] == 'close'
+
+
+def test_cache_dropped_on_a_new_data_version(tmp_path):
+    path = str(tmp_path / 'stili_al.csv')
+    shutil.copy(DATA_PATH, path)
+    server = ApiServer(path=path, workers=1)
+    server.cache.check_version(server.path, file_version(path))
+    server.cache.get_or_compute((server.path, file_version(path), 'stile'), lambda: (200, b'{}'))
+    os.utime(path, ns=(10**9, 10**9))
+    status, body, _ = asyncio.run(server.respond('/health', {}))
+    assert status == 200 and json.loads(body)['cache']['entries'] == 0
@@ -0,0 +1,80 @@
+import threading
+import pytest
+from utils_cache import ResultCache
+
+THREADS = 8
+
+
+def concurrent(cache, key, compute):
+    """Calls cache.get_or_compute(key, compute) from THREADS threads at once: (results, errors)."""
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(cache.get_or_compute(key, compute))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def blocking(value=None, error=None):
+    """compute function returning `value` (or raising `error`) once every thread is waiting, and its calls."""
+    calls = []
+
+    def compute(cache):
+        calls.append(1)
+        # let the other threads reach get_or_compute and wait on this computation
+        while cache.waits < THREADS - 1:
+            threading.Event().wait(0.001)
+        if error is not None:
+            raise error
+        return value
+    return compute, calls
+
+
+def test_concurrent_misses_compute_once():
+    cache = ResultCache()
+    compute, calls = blocking(value=[1, 2])
+    results, errors = concurrent(cache, 'k', lambda: compute(cache))
+    assert len(calls) == 1 and not errors
+    assert len(results) == THREADS and all(result is results[0] for result in results)
+    stats = cache.stats()
+    assert (stats['misses'], stats['waits']) == (1, THREADS - 1)
+    assert cache.get_or_compute('k', lambda: pytest.fail('computed again')) == [1, 2]
+
+
+def test_waiters_get_the_exception():
+    cache = ResultCache()
+    compute, calls = blocking(error=ValueError('boom'))
+    results, errors = concurrent(cache, 'k', lambda: compute(cache))
+    assert len(calls) == 1 and not results
+    assert len(errors) == THREADS and all(isinstance(e, ValueError) for e in errors)
+    # the failure is not cached: the next call computes
+    assert cache.get_or_compute('k', lambda: 3) == 3
+
+
+def test_expiry():
+    now = [0.0]
+    cache = ResultCache(ttl=10, clock=lambda: now[0])
+    assert cache.get_or_compute('k', lambda: 1) == 1
+    now[0] = 9.9
+    assert cache.get_or_compute('k', lambda: 2) == 1
+    now[0] = 10.0
+    assert cache.get_or_compute('k', lambda: 2) == 2
+    assert cache.stats()['expirations'] == 1
+
+
+def test_lru_eviction_and_versions():
+    cache = ResultCache(max_entries=2)
+    for key in ['a', 'b', 'a', 'c']:
+        cache.get_or_compute(('scope', key), lambda: key)
+    assert cache.get_or_compute(('scope', 'b'), lambda: 'new') == 'new'  # b was the least recently used
+    cache.check_version('scope', 1)
+    cache.check_version('scope', 2)
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,96 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils_agg import make_filters
+from utils_cache import ResultCache
+from utils_engine import CachedEngine
+from utils_store import ResultStore
+from utils_plot import RenderCache
+
+THREADS = 8
+
+
+def test_cached_engine_shares_one_computation(tmp_path):
+    cache = ResultCache()
+    store = ResultStore(str(tmp_path))
+    engine = CachedEngine('pandas', cache=cache, store=store)
+    # the same filter state, whatever the order of the compared countries
+    countries = engine.options['country']
+    selections = [make_filters(countries[0], countries[1:3]), make_filters(countries[0], countries[2:0:-1])]
+    barrier = threading.Barrier(THREADS)
+
+    def query(i):
+        filters, compare_by = selections[i % 2]
+        barrier.wait()
+        return engine.stile_matrix(filters, compare_by)
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        results = list(pool.map(query, range(THREADS)))
+    assert all(result is results[0] for result in results)
+    assert cache.stats()['misses'] == 1
+    assert store.stats()['process']['writes'] == 1
+
+
+def test_render_cache_bytes_under_concurrent_puts():
+    cache = RenderCache(max_bytes=10_000)
+    gets = 2000
+
+    def work(seed):
+        rng = random.Random(seed)
+        for _ in range(gets):
+            key = rng.randrange(50)
+            if cache.get(key) is None:
+                cache.put(key, b'x' * rng.randrange(100, 1000))
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == THREADS * gets
+    assert stats['bytes'] == sum(size for _, size in cache._items.values()) <= cache.max_bytes
+
+
+def test_cached_engine_drops_stored_results_of_another_shape(tmp_path):
+    import pandas as pd
+    from utils_data import DATA_PATH, file_version
+    from utils_engine import query_key
+    store = ResultStore(str(tmp_path))
+    filters = make_filters()[0]
+    key = query_key('cube', 'stile_counts', filters)
+    store.put(file_version(DATA_PATH), key, {'former': 'shape'})
+    engine = CachedEngine('cube', cache=ResultCache(), store=store)
+    assert isinstance(engine.stile_counts(filters), pd.Series)
+    assert isinstance(store.get(file_version(DATA_PATH), key), pd.Series)  # overwritten
+
+
+def test_concurrent_renders_with_mixed_themes():
+    import matplotlib
+    matplotlib.use('Agg')
+    from utils_contstants import COLORS, food, order_stile, order_frequenza
+    from utils_plot import DEFAULT_THEME, plot_horizontal_bar_chart, plot_vertical_bar_chart, figure_to_bytes
+    engine = CachedEngine('cube', cache=ResultCache())
+    filters, compare_by = make_filters('Italia', ['USA', 'Francia'])
+    stile = engine.stile_matrix(filters, compare_by)
+    stats = engine.product_stats(make_filters('Italia')[0])
+    products = list(food)[:3]
+    frequenza = [stats['frequenza'][product] for product in products]
+    charts = [
+        lambda theme: figure_to_bytes(plot_horizontal_bar_chart(
+            stile, order_stile, 'Stili alimentari', figsize=(10, 5), labels=list(stile.index), theme=theme)),
+        lambda theme: figure_to_bytes(plot_vertical_bar_chart(
+            frequenza, order_frequenza, 'Frequenza', labels=products, theme=theme)),
+    ]
+    themes = [DEFAULT_THEME.with_first(color) for color in COLORS[:2]]
+    jobs = [(chart, theme) for chart in range(len(charts)) for theme in range(len(themes))] * 4
+    expected = {(chart, theme): charts[chart](themes[theme]) for chart, theme in set(jobs)}
+
+    def render(job):
+        chart, theme = job
+        return charts[chart](themes[theme])
+
+    # neighbouring jobs alternate the theme, so concurrent renders mix them
+    with ThreadPoolExecutor(THREADS) as pool:
+        images = list(pool.map(render, jobs))
+    assert [image == expected[job] for job, image in zip(jobs, images)] == [True] * len(jobs)
@@ -0,0 +1,32 @@
+import os
+import shutil
+import pytest
+from utils_data import DATA_PATH
+from utils_agg import make_filters
+
+pytest.importorskip('duckdb')
+from utils_duck import DuckEngine, parquet_dir  # noqa: E402
+
+
+def new_version(path, i):
+    """Changes the csv at `path`: one more copy of its last row, and a new mtime."""
+    with open(path, 'rb') as f:
+        last = f.read().rstrip(b'\n').rsplit(b'\n', 1)[1]
+    with open(path, 'ab') as f:
+        f.write(last + b'\n')
+    os.utime(path, ns=(i * 10**9, i * 10**9))
+
+
+def test_previous_version_stays_readable(tmp_path):
+    path = str(tmp_path / 'stili_al.csv')
+    shutil.copy(DATA_PATH, path)
+    filters = make_filters()[0]
+    engines = []
+    for i in range(3):
+        if i:
+            new_version(path, 1000 + i)
+        engines.append(DuckEngine(path))
+    # the engine of the previous version still answers, the one before was removed
+    assert engines[2].n_rows(filters) == engines[1].n_rows(filters) + 1
+    assert len(os.listdir(parquet_dir(path))) == 2
+    assert not os.path.exists(engines[0].parquet)
@@ -0,0 +1,28 @@
+import os
+from utils_perf import RerunTrace, StageMetrics, metrics_path
+
+
+def test_metrics_path_per_process():
+    assert metrics_path('/m/stili.prom', pid=12) == '/m/stili.12.prom'
+    assert metrics_path('/m/stili.prom') == f'/m/stili.{os.getpid()}.prom'
+
+
+def test_dump_throttled(tmp_path):
+    now = [100.0]
+    metrics = StageMetrics(clock=lambda: now[0])
+    path = str(tmp_path / 'stili.1.prom')
+    trace = RerunTrace()
+    with trace.span('filter'):
+        pass
+    trace.finish(metrics)
+    assert metrics.dump(path, interval=10)
+    with open(path) as f:
+        text = f.read()
+    assert f'stili_stage_seconds_count{{stage="filter",pid="{os.getpid()}"}} 1' in text
+    trace.finish(metrics)
+    now[0] += 5
+    assert not metrics.dump(path, interval=10)
+    now[0] += 5
+    assert metrics.dump(path, interval=10)
+    with open(path) as f:
+        assert f'stili_stage_seconds_count{{stage="filter",pid="{os.getpid()}"}} 2' in f.read()
@@ -0,0 +1,84 @@
+import pickle
+from utils_store import ResultStore
+
+V1, V2 = (1, 100), (2, 200)
+
+
+def value(i, size=1000):
+    return {'i': i, 'pad': 'x' * size}
+
+
+def size_of(i, size=1000):
+    return len(pickle.dumps(value(i, size), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def counted_bytes(store):
+    con = store._connection()
+    return (con.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0],
+            con.execute('SELECT coalesce(sum(size), 0) FROM results').fetchone()[0])
+
+
+def test_results_and_hits_are_shared(tmp_path):
+    a, b = ResultStore(str(tmp_path)), ResultStore(str(tmp_path))
+    a.put(V1, ('stile_counts', 1), value(1))
+    assert b.get(V1, ('stile_counts', 1)) == value(1)
+    assert b.get(V1, ('stile_counts', 2)) is None
+    assert b.get(V2, ('stile_counts', 1)) is None  # other data version
+    b.flush()
+    results = a.stats()['results']
+    assert (results['entries'], results['hits'], results['misses']) == (1, 1, 2)
+    assert a.stats()['process']['writes'] == 1
+    # kept across restarts
+    assert ResultStore(str(tmp_path)).get(V1, ('stile_counts', 1)) == value(1)
+
+
+def test_least_recently_used_evicted_under_the_byte_cap(tmp_path):
+    cap = 2 * size_of(0) + size_of(0) // 2
+    a, b = ResultStore(str(tmp_path), max_bytes=cap), ResultStore(str(tmp_path), max_bytes=cap)
+    a.put(V1, 1, value(1))
+    a.put(V1, 2, value(2))
+    assert b.get(V1, 1) == value(1)  # 1 is now more recently used than 2
+    b.flush()
+    a.put(V1, 3, value(3))
+    assert b.get(V1, 2) is None
+    assert b.get(V1, 1) == value(1) and b.get(V1, 3) == value(3)
+    stats = b.stats()['results']
+    assert stats['evictions'] == 1 and stats['bytes'] <= cap
+    assert counted_bytes(a)[0] == counted_bytes(a)[1]
+
+
+def test_prune_drops_the_other_versions(tmp_path):
+    a, b = ResultStore(str(tmp_path)), ResultStore(str(tmp_path))
+    a.put(V1, 1, value(1))
+    a.put(V2, 1, value(2))
+    b.prune(V2)
+    assert a.get(V1, 1) is None
+    assert a.get(V2, 1) == value(2)
+    assert counted_bytes(a) == (size_of(2), size_of(2))
+
+
+def test_drifted_counter_evicts_nothing_that_fits(tmp_path):
+    store = ResultStore(str(tmp_path), max_bytes=10 * size_of(0))
+    store.put(V1, 1, value(1))
+    store._connection().execute("UPDATE counters SET value = 1000000000 WHERE name = 'bytes'")
+    store.put(V1, 2, value(2))
+    # the results fit under max_bytes: both kept, the counter recomputed
+    assert store.get(V1, 1) == value(1) and store.get(V1, 2) == value(2)
+    assert counted_bytes(store) == (size_of(1) + size_of(2),) * 2
+    assert store.stats()['results']['evictions'] == 0
+
+
+def test_eviction_ends_below_zero_bytes(tmp_path):
+    store = ResultStore(str(tmp_path), max_bytes=-1)
+    store.put(V1, 1, value(1))
+    assert counted_bytes(store) == (0, 0)
+
+
+def test_results_of_another_format_are_not_read(tmp_path, monkeypatch):
+    import utils_engine
+    from utils_agg import make_filters
+    store = ResultStore(str(tmp_path))
+    filters = make_filters()[0]
+    store.put(V1, utils_engine.query_key('cube', 'stile_counts', filters), 'former shape')
+    monkeypatch.setattr(utils_engine, 'RESULT_FORMAT', utils_engine.RESULT_FORMAT + 1)
+    assert store.get(V1, utils_engine.query_key('cube', 'stile_counts', filters)) is None
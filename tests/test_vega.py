@@ -0,0 +1,17 @@
+import math
+import pytest
+from utils_vega import vega_gauge
+
+
+def gauge_fraction(spec):
+    """Fraction of the half circle filled by the value arc of a vega_gauge spec."""
+    mark = spec['layer'][1]['mark']
+    return (mark['theta2'] - mark['theta']) / math.pi
+
+
+@pytest.mark.parametrize('value, fraction', [
+    (5, 0.5), (0, 0.0), (10, 1.0), (25, 1.0), (-3, 0.0),
+    (math.inf, 1.0), (-math.inf, 0.0), (math.nan, 0.0),
+])
+def test_gauge_clamped_to_the_limits(value, fraction):
+    assert gauge_fraction(vega_gauge(value, '#ff0000')) == pytest.approx(fraction)
@@ -0,0 +1,414 @@
+import numpy as np
+import pandas as pd
+from utils_contstants import food
+from utils_data import FILTER_COLUMNS, ANSWER_COLUMNS, FREQ_COLUMNS, CAM_COLUMNS
+
+# numeric columns of the products, in the column order of the value_totals arrays
+VALUE_COLUMNS = FREQ_COLUMNS + CAM_COLUMNS
+TOTALS = ['sums', 'sizes', 'ups', 'downs']
+
+
+#######################
+# Filters
+def make_filters(country='All', countries_compare=(), region='All', regions_compare=(),
+                 sesso='All', generazione='All', res_acq='All'):
+    """
+    Translates the sidebar selections into a filter state.
+
+    :return: (filters, compare_by). `filters` maps every column of FILTER_COLUMNS to the list of
+             accepted values (None = no filter); `compare_by` is the column the stile chart is split
+             by ('country', 'regione' or None when all the countries are shown together).
+    """
+    filters = dict.fromkeys(FILTER_COLUMNS)
+    compare_by = None
+    if country != 'All':
+        filters['country'] = [country] + list(countries_compare)
+        compare_by = 'country'
+        if region != 'All':
+            if regions_compare:
+                # comparing regions: the country selection is dropped
+                filters['country'] = None
+                filters['regione'] = [region] + list(regions_compare)
+                compare_by = 'regione'
+            else:
+                filters['regione'] = [region]
+    for col, value in (('sesso', sesso), ('generazione', generazione), ('res_acq', res_acq)):
+        if value != 'All':
+            filters[col] = [value]
+    return filters, compare_by
+
+
+def filters_key(filters) -> tuple:
+    """
+    Canonical, hashable form of a filter state: the same for the same accepted values, whatever
+    the order they were selected in (e.g. Italia compared with USA = USA compared with Italia).
+    """
+    return tuple((col, None if filters.get(col) is None else tuple(sorted(set(filters[col]))))
+                 for col in FILTER_COLUMNS)
+
+
+def filter_options(df) -> dict:
+    """Values of every filter column, in order of first appearance in the data."""
+    return {col: [str(value) for value in df[col].dropna().unique()] for col in FILTER_COLUMNS}
+
+
+def filter_df(df, filters) -> pd.DataFrame:
+    """Rows of `df` accepted by `filters` (see make_filters)."""
+    for col, values in filters.items():
+        if values is not None:
+            df = df[df[col].isin(values)]
+    return df
+
+
+def category_codes(values):
+    """
+    Category codes of a column as int64, with missing values mapped to an extra last code.
+
+    :return: (codes, labels)
+    """
+    values = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+    codes = values.cat.codes.to_numpy().astype(np.int64)
+    codes[codes < 0] = len(values.cat.categories)
+    return codes, [str(label) for label in values.cat.categories]
+
+
+def label_codes(values, labels):
+    """
+    Codes of `values` in a known list of `labels` (missing values = len(labels)), like
+    category_codes for the column the labels come from. None if a value is not in `labels`.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # translate the codes of the column's own categories (missing: -1 -> the last slot)
+        positions = pd.Index(labels).get_indexer([str(label) for label in values.cat.categories])
+        codes = np.append(positions, len(labels))[values.cat.codes.to_numpy()]
+        return None if (codes < 0).any() else codes
+    codes = pd.Categorical(values.astype(object), categories=labels).codes.astype(np.int64)
+    if ((codes < 0) & values.notna().to_numpy()).any():
+        return None
+    codes[codes < 0] = len(labels)
+    return codes
+
+
+def block_offsets(widths) -> np.ndarray:
+    """Start of every block in a concatenation of blocks of `widths` columns."""
+    return np.concatenate([[0], np.cumsum(widths)[:-1]]).astype(np.int64)
+
+
+#######################
+# Grouping function
+def group_df_all(df, metric: str) -> pd.Series:
+    # group for a bar chart
+    s = (df
+            .groupby(metric, observed=True)
+            .count()
+        ).country.sort_values()
+    return s
+
+
+def group_df(df, metric: str, compare_by: str) -> pd.Series:
+    # group for a bar chart
+    s = (df
+            .groupby([compare_by, metric], observed=True)
+            .country
+            .count()
+            #.sort_values()
+        )
+    return s
+
+
+def stile_matrix(df, compare_by, metric='stile') -> pd.DataFrame:
+    """
+    Dense form of group_df: respondents per value of `compare_by` (rows, the series of the
+    comparison chart) and of `metric` (columns), counted in one pass over the codes of the two
+    columns. Only the rows with respondents are kept, sorted like split_series.
+    """
+    group_codes, group_labels = category_codes(df[compare_by])
+    metric_codes, metric_labels = category_codes(df[metric])
+    width = len(metric_labels) + 1
+    counts = np.bincount(group_codes * width + metric_codes, minlength=(len(group_labels) + 1) * width)
+    return _matrix_frame(counts.reshape(-1, width)[:-1, :-1], group_labels, metric_labels, compare_by, metric)
+
+
+def _matrix_frame(counts, group_labels, metric_labels, compare_by, metric='stile') -> pd.DataFrame:
+    frame = pd.DataFrame(counts, index=pd.Index(group_labels, name=compare_by),
+                         columns=pd.Index(metric_labels, name=metric))
+    return frame[counts.sum(axis=1) > 0].sort_index()
+
+
+def split_series(s) -> list:
+    """One Series per value of the first index level of `s` (e.g. per country), named after it."""
+    series_list = []
+    for name, group in s.groupby(level=0):
+        series = group.reset_index(level=0, drop=True)
+        series.name = name
+        series_list.append(series)
+    return series_list
+
+
+def stile_crosstabs(stile_codes, n_stile, category_codes_list, category_sizes):
+    """
+    Counts of every category by stile in a single np.bincount over combined codes.
+
+    Each category gets a block of columns (its codes + a missing slot) at an offset of a wide
+    (stile x all categories) table, so the number of categories does not add passes over the rows.
+
+    :param stile_codes: Stile code of every row (missing = n_stile).
+    :param n_stile: Number of stile labels.
+    :param category_codes_list: Codes of every category column (missing = last code).
+    :param category_sizes: Number of labels of every category column.
+    :return: One array (n_stile + 1, size + 1) per category.
+    """
+    widths = np.array([size + 1 for size in category_sizes], dtype=np.int64)
+    offsets = block_offsets(widths)
+    width = int(widths.sum())
+    if width == 0:
+        return []
+    combined = stile_codes[:, None] * width + offsets + np.column_stack(category_codes_list)
+    counts = np.bincount(combined.ravel(), minlength=(n_stile + 1) * width).reshape(n_stile + 1, width)
+    return [counts[:, offset:offset + w] for offset, w in zip(offsets, widths)]
+
+
+def summary_table(stile_labels, total, category_tables, stile_col='stile') -> pd.DataFrame:
+    """
+    The aggregate_dataframe table: 'Total' then the observed labels of every category, one row per
+    observed stile, sorted by Total, without the 'Altro, non vuole indicare' column.
+
+    :param stile_labels: Stile labels, in code order.
+    :param total: Respondents per stile code.
+    :param category_tables: (labels, counts) of every category, counts shaped (stile, label).
+    """
+    columns = ['Total']
+    data = [np.asarray(total)[:len(stile_labels)]]
+    for labels, counts in category_tables:
+        counts = counts[:len(stile_labels), :len(labels)]
+        observed = counts.sum(axis=0) > 0
+        columns += [label for label, seen in zip(labels, observed) if seen]
+        data.append(counts[:, observed])
+    summary_df = pd.DataFrame(np.column_stack(data).astype(int), columns=columns,
+                              index=pd.Index(stile_labels, name=stile_col))
+    summary_df = summary_df[summary_df['Total'] > 0]
+
+    summary_df=summary_df.sort_values('Total', ascending=False)  # sort by total
+    if 'Altro, non vuole indicare' in summary_df.columns:
+        del summary_df['Altro, non vuole indicare']
+    return summary_df
+
+
+def aggregate_dataframe(df, stile_col='stile', categories=['regione', 'sesso', 'generazione']):
+    """
+    Aggregates a DataFrame by a 'stile' column and counts occurrences of specified categories.
+
+    All the category-by-stile counts come from one pass over the integer codes (see stile_crosstabs).
+
+    Parameters:
+    - df: DataFrame to be processed.
+    - stile_col: The name of the column to group by. Default is 'stile'.
+    - categories: List of column names to count occurrences for. Default is ['regione', 'sesso', 'generazione'].
+
+    Returns:
+    - A new DataFrame with the total count and counts for specified categories by 'stile'.
+    """
+    stile_codes, stile_labels = category_codes(df[stile_col])
+    codes_list, labels_list = [], []
+    for category in categories:
+        codes, labels = category_codes(df[category])
+        codes_list.append(codes)
+        labels_list.append(labels)
+
+    total = np.bincount(stile_codes, minlength=len(stile_labels) + 1)
+    tables = stile_crosstabs(stile_codes, len(stile_labels), codes_list, [len(l) for l in labels_list])
+    return summary_table(stile_labels, total, list(zip(labels_list, tables)), stile_col)
+
+
+#######################
+# Products
+def answer_counts(df, columns) -> list:
+    """value_counts of every column in `columns` (the q4__*/q5__* answers of the products)."""
+    return [df[col].value_counts() for col in columns]
+
+
+def mean_values(df, columns) -> dict:
+    """Mean of every column in `columns` (the freq_* volte al mese of the products)."""
+    return {col: df[col].mean() for col in columns}
+
+
+def growth_rates(df, columns) -> dict:
+    """
+    Growth rate in % of every cam_* column in `columns`: respondents who increased (1) over
+    respondents who decreased (-1), minus 1.
+    """
+    rates = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col in columns:
+            values = df[col]
+            rates[col] = (np.float64((values == 1).sum()) / (values == -1).sum() - 1) * 100
+    return rates
+
+
+def value_totals(values) -> np.ndarray:
+    """
+    Totals of a (rows x columns) float matrix of freq_*/cam_* values, one row per kind of TOTALS:
+    sum and number of the non missing values, number of values equal to 1 and to -1.
+    """
+    valid = ~np.isnan(values)
+    return np.stack([np.where(valid, values, 0).sum(axis=0), valid.sum(axis=0),
+                     (values == 1).sum(axis=0), (values == -1).sum(axis=0)]).astype(np.float64)
+
+
+def product_summary(answer_labels, answer_counts, totals) -> dict:
+    """
+    Statistics of all the products of `food` from their counts and totals.
+
+    :param answer_labels: Labels of every column of ANSWER_COLUMNS.
+    :param answer_counts: Respondents per code of every column of ANSWER_COLUMNS (last slot = missing).
+    :param totals: (TOTALS x VALUE_COLUMNS) array, see value_totals.
+    :return: {'frequenza': product -> answer counts of its q4__* column (like answer_counts),
+              'cambiamento': product -> answer counts of its q5__* column,
+              'mean': product -> mean volte al mese (like mean_values),
+              'growth': product -> growth rate in % (like growth_rates)}
+    """
+    series = {}
+    for col, labels, counts in zip(ANSWER_COLUMNS, answer_labels, answer_counts):
+        counts = np.asarray(counts)[:len(labels)]
+        order = np.argsort(-counts, kind='stable')  # like sort_values(ascending=False, kind='stable')
+        series[col] = pd.Series(counts[order], index=pd.Index(labels, name=col)[order], name='count')
+    sums, sizes, ups, downs = totals
+    n = len(FREQ_COLUMNS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums[:n] / sizes[:n]
+        rates = (ups[n:] / downs[n:] - 1) * 100
+    return {
+        'frequenza': {product: series[cols[0]] for product, cols in food.items()},
+        'cambiamento': {product: series[cols[1]] for product, cols in food.items()},
+        'mean': dict(zip(food, means)),
+        'growth': dict(zip(food, rates)),
+    }
+
+
+def product_stats(df) -> dict:
+    """
+    Answer counts, mean volte al mese and growth rate of all the products of `food` over the rows
+    of `df`: one np.bincount over the codes of every q4__*/q5__* column (see stile_crosstabs) and
+    one pass over the (rows x VALUE_COLUMNS) matrix, whatever the number of products shown.
+    See product_summary for the result.
+    """
+    codes_list, labels_list = zip(*(category_codes(df[col]) for col in ANSWER_COLUMNS))
+    widths = [len(labels) + 1 for labels in labels_list]
+    offsets = block_offsets(widths)
+    counts = np.bincount((np.column_stack(codes_list) + offsets).ravel(), minlength=sum(widths))
+    totals = value_totals(df[VALUE_COLUMNS].to_numpy(dtype=np.float64))
+    return product_summary(labels_list, np.split(counts, offsets[1:]), totals)
+
+
+#######################
+# Engines
+class Aggregator:
+    """
+    Base of the engines that answer the dashboard queries from category counts instead of
+    filtering a DataFrame. Its methods return the same shapes as the pandas functions above.
+
+    Subclasses set `labels` (column -> category labels, in code order) and `options` (see
+    filter_options), and implement two primitives over the rows accepted by `filters`:
+    - `_counts(col, filters, keep=None)`: respondents per code of `col`, the last slot counting
+      missing values; if `keep` is given, a 2d array with one row per code of `keep` (+ missing);
+    - `_total(kind, col, filters)`: 'sums' or 'sizes' (number of non missing values) of a numeric
+      column, 'ups' or 'downs' (values equal to 1 or -1) of a cam_* column;
+    and, for all the products at once:
+    - `_product_totals(filters)`: (counts, totals), the respondents per code of every column of
+      ANSWER_COLUMNS concatenated in blocks starting at `self.answer_offsets`, and the
+      (TOTALS x VALUE_COLUMNS) array of value_totals.
+    """
+
+    def n_rows(self, filters):
+        return int(self._counts('stile', filters)[:-1].sum())
+
+    def stile_counts(self, filters) -> pd.Series:
+        """Like group_df_all(filter_df(df, filters), 'stile')."""
+        counts = self._counts('stile', filters)[:-1]
+        s = pd.Series(counts, index=pd.Index(self.labels['stile'], name='stile'), name='country')
+        return s[s > 0].sort_values()
+
+    def stile_counts_by(self, filters, compare_by) -> pd.Series:
+        """Like group_df(filter_df(df, filters), 'stile', compare_by)."""
+        counts = self._counts('stile', filters, keep=compare_by)[:-1, :-1]
+        index = pd.MultiIndex.from_product([self.labels[compare_by], self.labels['stile']],
+                                           names=[compare_by, 'stile'])
+        s = pd.Series(counts.ravel(), index=index, name='country')
+        return s[s > 0]
+
+    def stile_matrix(self, filters, compare_by) -> pd.DataFrame:
+        """Like stile_matrix(filter_df(df, filters), compare_by)."""
+        counts = self._counts('stile', filters, keep=compare_by)[:-1, :-1]
+        return _matrix_frame(counts, self.labels[compare_by], self.labels['stile'], compare_by)
+
+    def category_table(self, filters, categories=['regione', 'sesso', 'generazione']) -> pd.DataFrame:
+        """Like aggregate_dataframe(filter_df(df, filters), categories=categories)."""
+        total = self._counts('stile', filters)
+        tables = [(self.labels[category], self._counts('stile', filters, keep=category).T)
+                  for category in categories]
+        return summary_table(self.labels['stile'], total, tables)
+
+    def answer_counts(self, filters, columns) -> list:
+        """Like answer_counts(filter_df(df, filters), columns)."""
+        series_list = []
+        for col in columns:
+            counts = self._counts(col, filters)[:-1]
+            s = pd.Series(counts, index=pd.Index(self.labels[col], name=col), name='count')
+            series_list.append(s.sort_values(ascending=False, kind='stable'))
+        return series_list
+
+    def mean_values(self, filters, columns) -> dict:
+        """Like mean_values(filter_df(df, filters), columns)."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {col: np.float64(self._total('sums', col, filters)) / self._total('sizes', col, filters)
+                    for col in columns}
+
+    def growth_rates(self, filters, columns) -> dict:
+        """Like growth_rates(filter_df(df, filters), columns)."""
+        rates = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for col in columns:
+                ups = np.float64(self._total('ups', col, filters))
+                rates[col] = (ups / self._total('downs', col, filters) - 1) * 100
+        return rates
+
+    def product_stats(self, filters) -> dict:
+        """Like product_stats(filter_df(df, filters))."""
+        counts, totals = self._product_totals(filters)
+        return product_summary([self.labels[col] for col in ANSWER_COLUMNS],
+                               np.split(counts, self.answer_offsets[1:]), totals)
+
+
+class PandasEngine:
+    """The pandas functions above behind the engine interface (reference implementation)."""
+
+    def __init__(self, df):
+        self.df = df
+        self.options = filter_options(df)
+
+    def n_rows(self, filters):
+        return len(filter_df(self.df, filters))
+
+    def stile_counts(self, filters):
+        return group_df_all(filter_df(self.df, filters), 'stile')
+
+    def stile_counts_by(self, filters, compare_by):
+        return group_df(filter_df(self.df, filters), 'stile', compare_by)
+
+    def stile_matrix(self, filters, compare_by):
+        return stile_matrix(filter_df(self.df, filters), compare_by)
+
+    def category_table(self, filters, categories=['regione', 'sesso', 'generazione']):
+        return aggregate_dataframe(filter_df(self.df, filters), categories=categories)
+
+    def answer_counts(self, filters, columns):
+        return answer_counts(filter_df(self.df, filters), columns)
+
+    def mean_values(self, filters, columns):
+        return mean_values(filter_df(self.df, filters), columns)
+
+    def growth_rates(self, filters, columns):
+        return growth_rates(filter_df(self.df, filters), columns)
+
+    def product_stats(self, filters):
+        return product_stats(filter_df(self.df, filters))
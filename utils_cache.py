@@ -0,0 +1,108 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class _Flight:
+    """A computation in progress: its waiters are woken by `event`, then read `value` or `error`."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    Process-wide cache of query results, shared by all the Streamlit sessions of a worker.
+
+    LRU over at most `max_entries` results, each kept `ttl` seconds. Concurrent requests of a
+    missing key are single-flighted: the first one computes, the others wait for its result (or
+    its exception). Keys start with a scope (e.g. engine and data file) whose entries are dropped
+    when its data version changes (see check_version). The results are shared: callers must not
+    modify them.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._items = OrderedDict()  # key -> (expiry, value)
+        self._inflight = {}          # key -> _Flight of its computation
+        self._versions = {}          # scope -> data version
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.waits = 0
+        self.evictions = self.expirations = self.invalidations = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        The cached value of `key`, computed with `compute()` if missing. Concurrent callers of a
+        missing key wait for the first one: they get its value, or its exception raised again.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] > self._clock():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._items[key]
+                self.expirations += 1
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+                owner = True
+            else:
+                self.waits += 1
+                owner = False
+        if not owner:
+            # another session is computing it
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+            raise
+        with self._lock:
+            self._items[key] = (self._clock() + self.ttl, flight.value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.evictions += 1
+            del self._inflight[key]
+        flight.event.set()
+        return flight.value
+
+    def check_version(self, scope, version):
+        """Drops the entries whose key starts with `scope` if its data version is not `version`."""
+        with self._lock:
+            if self._versions.get(scope, version) != version:
+                stale = [key for key in self._items if key[0] == scope]
+                for key in stale:
+                    del self._items[key]
+                self.invalidations += len(stale)
+            self._versions[scope] = version
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._items), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'waits': self.waits,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'invalidations': self.invalidations}
+
+
+# results of the dashboard queries (see utils_engine.CachedEngine)
+result_cache = ResultCache()
@@ -25,6 +25,8 @@ RED_DARK = '#A81829'
 GOLDLIGHT = '#F2CF9A'
 GOLD_DARK = '#674E1F'
 
+COLORS = [BLUE, CYAN, GREEN, RED, YELLOW, OLIVE, PURPLE, GOLD]  # default order of the series colors
+
 
 food = {
 "🧁 pasticceria": ['q4__4', 'q5__4', 'freq_past', 'cam_past'],
@@ -0,0 +1,160 @@
+import copy
+import numpy as np
+import pandas as pd
+from utils_data import (DATA_PATH, FILTER_COLUMNS, ANSWER_COLUMNS, CATEGORY_COLUMNS, CHUNK_ROWS, survey_labels,
+                        read_survey_chunks)
+from utils_agg import Aggregator, VALUE_COLUMNS, TOTALS, category_codes, label_codes, block_offsets
+
+class Cube(Aggregator):
+    """
+    Precomputed counts of the survey over every combination of the sidebar filters.
+
+    Each filter dimension of FILTER_COLUMNS is indexed by the category codes of the column plus a
+    last slot for missing values (e.g. the regione of non Italian respondents). The cubes are:
+    - counts['stile'] and counts[q4__*/q5__*]: respondents per filter cell x answer (last answer slot
+      = missing answer). The answer counts are views of one `answers` cube holding all the
+      q4__*/q5__* columns side by side (blocks at `answer_offsets`);
+    - totals: per filter cell x kind of TOTALS x column of VALUE_COLUMNS, the sum and number of non
+      missing freq_*/cam_* values and the respondents whose value is 1 or -1 (consumption increased
+      or decreased).
+
+    Every chart of the dashboard is then a slice-and-sum over these arrays, whose size depends on
+    the number of categories only, not on the number of respondents.
+    """
+
+    dims = FILTER_COLUMNS
+
+    def __init__(self, df):
+        self.labels = {}   # column -> category labels (code order)
+        self.options = {}  # filter column -> labels in order of first appearance in the data
+        codes = {}
+        for dim in self.dims:
+            codes[dim], labels = category_codes(df[dim])
+            self.labels[dim] = labels
+            seen = pd.unique(codes[dim])
+            self.options[dim] = [labels[code] for code in seen if code < len(labels)]
+        for col in ['stile'] + ANSWER_COLUMNS:
+            codes[col], self.labels[col] = category_codes(df[col])
+        self._allocate()
+        self._add(df, codes)
+
+    @classmethod
+    def from_csv(cls, path=DATA_PATH, chunksize=CHUNK_ROWS):
+        """
+        The Cube of the survey csv at `path`, streamed `chunksize` rows at a time in two passes
+        (the labels of the category columns, then the counts of every chunk). Only the columns
+        the cubes need are parsed and no chunk is kept: the memory used is bounded by the size of
+        the cubes and of one chunk, not by the number of respondents.
+        """
+        cube = cls.__new__(cls)
+        cube.labels, first_seen = survey_labels(path, chunksize=chunksize)
+        cube.options = {dim: first_seen[dim] for dim in cls.dims}
+        cube._allocate()
+        for chunk in read_survey_chunks(path, chunksize=chunksize):
+            codes = {}
+            for col in CATEGORY_COLUMNS:
+                codes[col] = label_codes(chunk[col], cube.labels[col])
+                if codes[col] is None:
+                    raise ValueError(f"{path} changed while it was read: new labels in {col}")
+            cube._add(chunk, codes)
+        return cube
+
+    def _allocate(self):
+        """Zeroed cubes for the categories of self.labels."""
+        self.shape = tuple(len(self.labels[dim]) + 1 for dim in self.dims)
+        self.n_cells = int(np.prod(self.shape))
+        widths = [len(self.labels[col]) + 1 for col in ANSWER_COLUMNS]
+        self.answer_offsets = block_offsets(widths)
+
+        self.counts = {'stile': np.zeros(self.shape + (len(self.labels['stile']) + 1,), dtype=np.int64)}
+        self.answers = np.zeros(self.shape + (sum(widths),), dtype=np.int64)
+        self.totals = np.zeros(self.shape + (len(TOTALS), len(VALUE_COLUMNS)))
+        self._answer_views()
+
+    def _answer_views(self):
+        for col, offset in zip(ANSWER_COLUMNS, self.answer_offsets):
+            self.counts[col] = self.answers[..., offset:offset + len(self.labels[col]) + 1]
+
+    def _add(self, df, codes):
+        """Adds to the cubes the respondents of `df`, whose category codes are `codes`."""
+        cell = np.ravel_multi_index([codes[dim] for dim in self.dims], self.shape)
+
+        size = self.counts['stile'].shape[-1]
+        self.counts['stile'] += np.bincount(cell * size + codes['stile'],
+                                            minlength=self.n_cells * size).reshape(self.counts['stile'].shape)
+
+        width = self.answers.shape[-1]
+        combined = cell[:, None] * width + self.answer_offsets + np.column_stack([codes[col] for col in ANSWER_COLUMNS])
+        self.answers += np.bincount(combined.ravel(), minlength=self.n_cells * width).reshape(self.answers.shape)
+
+        for j, col in enumerate(VALUE_COLUMNS):
+            values = df[col].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(values)
+            self.totals[..., 0, j] += self._per_cell(cell[valid], values[valid])
+            self.totals[..., 1, j] += self._per_cell(cell[valid])
+            self.totals[..., 2, j] += self._per_cell(cell[values == 1])
+            self.totals[..., 3, j] += self._per_cell(cell[values == -1])
+
+    def _per_cell(self, cell, weights=None):
+        return np.bincount(cell, weights=weights, minlength=self.n_cells).reshape(self.shape)
+
+    def extend(self, df):
+        """
+        A new Cube with the respondents of `df` added to the ones of this one, which is left
+        untouched for the queries still using it. None if `df` has a category this cube has no
+        slot for (e.g. a new country): the cube must then be rebuilt.
+        """
+        codes = {}
+        for col in list(self.dims) + ['stile'] + ANSWER_COLUMNS:
+            codes[col] = label_codes(df[col], self.labels[col])
+            if codes[col] is None:
+                return None
+        cube = copy.copy(self)
+        cube.counts = {'stile': self.counts['stile'].copy()}
+        cube.answers = self.answers.copy()
+        cube.totals = self.totals.copy()
+        cube._answer_views()
+        cube._add(df, codes)
+        return cube
+
+    def nbytes(self):
+        return self.counts['stile'].nbytes + self.answers.nbytes + self.totals.nbytes
+
+    #######################
+    # Slicing
+    def _index(self, filters):
+        """Per dimension codes of the cells accepted by `filters` (see utils_agg.make_filters)."""
+        index = []
+        for dim, size in zip(self.dims, self.shape):
+            values = filters.get(dim)
+            if values is None:
+                index.append(np.arange(size))
+            else:
+                labels = self.labels[dim]
+                index.append(np.unique([labels.index(v) for v in values if v in labels]).astype(np.int64))
+        return index
+
+    def _reduce(self, cube, filters, keep=None):
+        """
+        Sums `cube` over the cells accepted by `filters`. If `keep` is a filter column, that
+        dimension is kept (full size, zeros for the cells not selected) as the first axis.
+        """
+        index = self._index(filters)
+        trailing = [np.arange(n) for n in cube.shape[len(self.dims):]]
+        sliced = cube[np.ix_(*index, *trailing)]
+        if keep is None:
+            return sliced.sum(axis=tuple(range(len(self.dims))))
+        k = self.dims.index(keep)
+        reduced = np.moveaxis(sliced, k, 0).sum(axis=tuple(range(1, len(self.dims))))
+        full = np.zeros((self.shape[k],) + reduced.shape[1:], dtype=reduced.dtype)
+        full[index[k]] = reduced
+        return full
+
+    def _counts(self, col, filters, keep=None):
+        return self._reduce(self.counts[col], filters, keep)
+
+    def _total(self, kind, col, filters):
+        return self._reduce(self.totals[..., TOTALS.index(kind), VALUE_COLUMNS.index(col)], filters).sum()
+
+    def _product_totals(self, filters):
+        return self._reduce(self.answers, filters), self._reduce(self.totals, filters)
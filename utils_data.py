@@ -0,0 +1,555 @@
+import io
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from utils_contstants import food, order_stile, order_frequenza, order_cambiamento
+
+logger = logging.getLogger(__name__)
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stili_al.csv')
+SNAPSHOT_FORMAT = 1
+
+# raw csv name -> name used by the dashboard
+RENAME_COLUMNS = {'area': 'regione', 's3': 'sesso', 'generation': 'generazione'}
+REPLACE_VALUES = {'Nessuno di questi': 'Nessuno stile'}
+
+FILTER_COLUMNS = ['country', 'regione', 'sesso', 'generazione', 'res_acq']
+ANSWER_COLUMNS = [cols[0] for cols in food.values()] + [cols[1] for cols in food.values()]  # q4__*, q5__*
+FREQ_COLUMNS = [cols[2] for cols in food.values()]  # freq_*: volte al mese (0, 1, 2.5, 4, 10, 30)
+CAM_COLUMNS = [cols[3] for cols in food.values()]   # cam_*: -1, 0, 1
+
+CATEGORY_COLUMNS = FILTER_COLUMNS + ['stile'] + ANSWER_COLUMNS
+
+# columns read by each view of the dashboard
+VIEW_COLUMNS = {
+    'sidebar': FILTER_COLUMNS,
+    'stile': FILTER_COLUMNS + ['stile'],
+    'table': FILTER_COLUMNS + ['stile'],
+    'products': FILTER_COLUMNS + ANSWER_COLUMNS + FREQ_COLUMNS + CAM_COLUMNS,
+}
+# columns of the survey the dashboard reads (normalized names): the others (id__, anni, regio,
+# eta, s5, the q3ter free text...) are not loaded by the 'dashboard' profile
+USED_COLUMNS = list(dict.fromkeys(col for columns in VIEW_COLUMNS.values() for col in columns))
+# load profiles: columns of the frame loaded by load_data (None: all of them)
+LOAD_PROFILES = {
+    'dashboard': USED_COLUMNS,
+    'full': None,
+}
+LOAD_PROFILE = os.environ.get('STILI_LOAD_PROFILE', 'dashboard')
+
+# accepted values of the columns of a new batch of respondents (see validate_batch)
+FREQ_VALUES = [0, 1, 2.5, 4, 10, 30]
+CAM_VALUES = [-1, 0, 1]
+
+_RAW_NAMES = {new: old for old, new in RENAME_COLUMNS.items()}
+
+CSV_DTYPES = {_RAW_NAMES.get(col, col): 'category' for col in CATEGORY_COLUMNS}
+CSV_DTYPES.update({col: 'float32' for col in FREQ_COLUMNS})
+CSV_DTYPES.update({col: 'int8' for col in CAM_COLUMNS})
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def rss_bytes():
+    """Resident memory of the current process in bytes (None if it cannot be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # no /proc (macOS): fall back to the peak, reported in bytes there
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def file_version(path=DATA_PATH):
+    """Cheap version key of a data file: (mtime in ns, size)."""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def atomic_write(path, data):
+    """Writes the bytes `data` to `path` through a temporary file: readers never see a partial file."""
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def normalize(df):
+    """
+    Applies the dashboard naming to a raw survey frame: 'area' -> 'regione', 's3' -> 'sesso',
+    'generation' -> 'generazione' and 'Nessuno di questi' -> 'Nessuno stile' in every column.
+    """
+    df = df.rename(columns=RENAME_COLUMNS)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            found = {old: new for old, new in REPLACE_VALUES.items() if old in df[col].cat.categories}
+            if found:
+                df[col] = df[col].cat.rename_categories(found)
+        elif not pd.api.types.is_numeric_dtype(df[col].dtype):
+            df[col] = df[col].replace(REPLACE_VALUES)
+    return df
+
+
+def _raw_columns(columns):
+    return None if columns is None else [_RAW_NAMES.get(col, col) for col in columns]
+
+
+def intern_strings(df):
+    """
+    The text columns of `df` not typed by CSV_DTYPES (e.g. the q3ter free text, repeated verbatim
+    on many rows) as categories: one copy of each distinct string plus integer codes.
+    """
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col].dtype) and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def read_survey(path=DATA_PATH, columns=None):
+    """
+    Parses the survey csv with explicit dtypes and the dashboard naming.
+
+    :param columns: Columns to parse (normalized names, e.g. USED_COLUMNS); default: all of them.
+    """
+    return normalize(intern_strings(pd.read_csv(path, dtype=CSV_DTYPES, usecols=_raw_columns(columns))))
+
+
+CHUNK_ROWS = 200_000
+
+
+def read_survey_chunks(path=DATA_PATH, columns=USED_COLUMNS, chunksize=CHUNK_ROWS):
+    """
+    Reads the survey csv `chunksize` rows at a time, parsing only `columns`.
+
+    :return: Iterator of normalized DataFrames (see read_survey), one per chunk.
+    """
+    raw = _raw_columns(columns)
+    with pd.read_csv(path, usecols=raw, dtype={col: CSV_DTYPES[col] for col in raw if col in CSV_DTYPES},
+                     chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield normalize(chunk)
+
+
+def survey_labels(path=DATA_PATH, columns=CATEGORY_COLUMNS, chunksize=CHUNK_ROWS):
+    """
+    Labels of the category `columns` of the survey csv, read in chunks of these columns only.
+
+    :return: ({col: labels}, {col: labels in order of first appearance}); the first are the
+             categories read_survey gives the column (sorted raw values, then normalized).
+    """
+    raw = _raw_columns(columns)
+    found = {col: set() for col in raw}
+    first_seen = {col: {} for col in raw}
+    with pd.read_csv(path, usecols=raw, dtype={col: 'category' for col in raw}, chunksize=chunksize) as reader:
+        for chunk in reader:
+            for col in raw:
+                values = chunk[col]
+                found[col].update(values.cat.categories)
+                for label in pd.unique(values.dropna()):
+                    first_seen[col].setdefault(label, None)
+    labels, order = {}, {}
+    for col, name in zip(raw, columns):
+        labels[name] = [REPLACE_VALUES.get(label, label) for label in sorted(found[col])]
+        order[name] = [REPLACE_VALUES.get(label, label) for label in first_seen[col]]
+    return labels, order
+
+
+#######################
+# Columnar snapshot
+def snapshot_path(path=DATA_PATH):
+    """Directory of the binary snapshot built from the csv at `path`."""
+    return os.path.splitext(os.path.abspath(path))[0] + '.snapshot'
+
+
+def _codes_dtype(n_labels):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_labels <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def build_snapshot(path=DATA_PATH, out_dir=None):
+    """
+    Converts the survey csv into a columnar snapshot that workers can memory-map.
+
+    Every column is written as a `.npy` file: text columns are dictionary-encoded as integer codes
+    (-1 for missing values) and their labels go in a table shared by the columns with the same
+    categories (all the q4__* columns share one entry, all the q5__* another). `meta.json` stores
+    the label table, the column kinds and the version of the source csv. Column names and values
+    are the normalized ones (see `normalize`).
+
+    :param path: Path of the csv file.
+    :param out_dir: Output directory. Defaults to `snapshot_path(path)`.
+    :return: The output directory.
+    """
+    out_dir = out_dir or snapshot_path(path)
+    df = read_survey(path)
+    tmp_dir = out_dir + '.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    labels = {}  # table name -> labels
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values.dtype):
+            values = values.astype('category')
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            col_labels = [str(label) for label in values.cat.categories]
+            table = next((name for name, known in labels.items() if known == col_labels), col)
+            labels[table] = col_labels
+            array = values.cat.codes.to_numpy().astype(_codes_dtype(len(col_labels)))
+            columns.append({'name': col, 'kind': 'category', 'labels': table})
+        else:
+            array = values.to_numpy()
+            columns.append({'name': col, 'kind': 'numeric'})
+        np.save(os.path.join(tmp_dir, f'{col}.npy'), np.ascontiguousarray(array))
+
+    meta = {
+        'format': SNAPSHOT_FORMAT,
+        'source_version': list(file_version(path)),
+        'rows': len(df),
+        'columns': columns,
+        'labels': labels,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+
+    # swap the directories so that readers never see a half written snapshot
+    if os.path.isdir(out_dir):
+        old_dir = out_dir + '.old'
+        os.replace(out_dir, old_dir)
+        os.replace(tmp_dir, out_dir)
+        for name in os.listdir(old_dir):
+            os.remove(os.path.join(old_dir, name))
+        os.rmdir(old_dir)
+    else:
+        os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def read_snapshot_meta(snapshot_dir):
+    """The `meta.json` of a snapshot (None if there is no snapshot)."""
+    try:
+        with open(os.path.join(snapshot_dir, 'meta.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def read_snapshot(snapshot_dir, meta=None, columns=None):
+    """
+    Opens a snapshot as a DataFrame backed by read-only memory maps: the pages are shared
+    through the OS page cache by every process reading the same snapshot.
+
+    :param columns: Columns to open (default: all of them).
+    """
+    meta = meta or read_snapshot_meta(snapshot_dir)
+    data = {}
+    for column in meta['columns']:
+        if columns is not None and column['name'] not in columns:
+            continue
+        array = np.load(os.path.join(snapshot_dir, column['name'] + '.npy'), mmap_mode='r')
+        if column['kind'] == 'category':
+            array = pd.Categorical.from_codes(array, categories=meta['labels'][column['labels']])
+        data[column['name']] = array
+    return pd.DataFrame(data, copy=False)
+
+
+#######################
+# Incremental ingestion
+def appends_path(path=DATA_PATH):
+    """Log of the batches appended to the csv at `path` (one json line per batch, see append_batch)."""
+    return os.path.abspath(path) + '.appends'
+
+
+def validate_batch(df):
+    """
+    Checks a normalized batch of respondents before it is appended to the survey: every stile is
+    one of order_stile, every q4__* answer one of order_frequenza, every q5__* answer one of
+    order_cambiamento, the freq_* values are in FREQ_VALUES (or missing) and the cam_* ones in
+    CAM_VALUES.
+
+    :raise ValueError: listing the columns with unexpected values.
+    """
+    expected = {'stile': order_stile}
+    expected.update({col: order_frequenza for col in ANSWER_COLUMNS if col.startswith('q4')})
+    expected.update({col: order_cambiamento for col in ANSWER_COLUMNS if col.startswith('q5')})
+    errors = []
+    for col, allowed in expected.items():
+        values = df[col].astype(object)
+        unknown = sorted({str(v) for v in values[~values.isin(allowed)]})
+        if unknown:
+            errors.append(f"{col}: {unknown}")
+    for col, allowed in [(col, FREQ_VALUES) for col in FREQ_COLUMNS] + [(col, CAM_VALUES) for col in CAM_COLUMNS]:
+        values = df[col]
+        unknown = sorted(set(values[values.notna() & ~values.isin(allowed)].tolist()))
+        if unknown or (col in CAM_COLUMNS and values.isna().any()):
+            errors.append(f"{col}: {unknown or 'missing values'}")
+    if errors:
+        raise ValueError("Unexpected values in the batch: " + "; ".join(errors))
+
+
+def _lock_file(path):
+    """Exclusive lock of `path` + '.lock' between processes (None where fcntl is not available)."""
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    f = open(path + '.lock', 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def append_batch(batch_path, path=DATA_PATH):
+    """
+    Appends a batch of new respondents (a csv with the columns of the survey, in any order) to
+    the survey csv at `path`.
+
+    The batch is normalized and validated first (see validate_batch). The new file is written
+    next to the old one and swapped in with os.replace, so readers see either the old or the new
+    file, and its version (see file_version) is logged in appends_path(path) before the swap:
+    processes holding the old data read only the appended bytes (see read_appended) instead of
+    the whole file.
+
+    :return: {'rows', 'from_version', 'to_version'}
+    """
+    path = os.path.abspath(path)
+    with open(path, newline='') as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    raw = pd.read_csv(batch_path, dtype=str, keep_default_na=False)
+    missing, extra = set(header) - set(raw.columns), set(raw.columns) - set(header)
+    if missing or extra:
+        raise ValueError(f"The batch columns do not match the survey: missing {sorted(missing)}, "
+                         f"unexpected {sorted(extra)}")
+    try:
+        batch = normalize(pd.read_csv(batch_path, dtype=CSV_DTYPES))
+    except ValueError as e:
+        raise ValueError(f"Cannot parse the batch: {e}") from e
+    validate_batch(batch)
+    rows = raw[header].to_csv(header=False, index=False, lineterminator='\n').encode()
+
+    lock = _lock_file(path)
+    try:
+        from_version = file_version(path)
+        tmp = path + '.tmp'
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            data = src.read()
+            dst.write(data)
+            if data and not data.endswith(b'\n'):
+                dst.write(b'\n')
+            dst.write(rows)
+        # the version of the new file is chosen before it becomes visible
+        mtime_ns = max(time.time_ns(), from_version[0] + 1)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        to_version = file_version(tmp)
+        with open(appends_path(path), 'a') as log:
+            log.write(json.dumps({'from': list(from_version), 'to': list(to_version), 'rows': len(raw)}) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(tmp, path)
+    finally:
+        if lock is not None:
+            lock.close()
+    logger.info("appended %d rows to %s", len(raw), path)
+    return {'rows': len(raw), 'from_version': from_version, 'to_version': to_version}
+
+
+def read_appended(path, old_version, new_version, columns=None):
+    """
+    The rows appended to `path` between two of its versions, normalized (None if the file did
+    not change only by appends in between, see append_batch).
+
+    :param columns: Columns to parse (default: all of them).
+    """
+    steps = {}
+    try:
+        with open(appends_path(path)) as log:
+            for line in log:
+                step = json.loads(line)
+                steps[tuple(step['from'])] = tuple(step['to'])
+    except FileNotFoundError:
+        return None
+    version = tuple(old_version)
+    while version != tuple(new_version):
+        if version not in steps:
+            return None
+        version = steps[version]
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(old_version[1])
+        tail = f.read(new_version[1] - old_version[1])
+    return normalize(pd.read_csv(io.BytesIO(header + tail), dtype=CSV_DTYPES, usecols=_raw_columns(columns)))
+
+
+def concat_frames(df, batch):
+    """
+    The rows of `batch` after the ones of `df`. Categorical columns of `df` get the new labels of
+    `batch` at the end of their categories, so the codes of the rows of `df` do not change.
+    """
+    data = {}
+    for col in df.columns:
+        old, new = df[col], batch[col]
+        if isinstance(old.dtype, pd.CategoricalDtype):
+            known = set(old.cat.categories)
+            labels = list(old.cat.categories) + [v for v in pd.unique(new.dropna().astype(str)) if v not in known]
+            new_codes = pd.Categorical(new.astype(object), categories=labels).codes
+            codes = np.concatenate([old.cat.codes.to_numpy(), new_codes]).astype(_codes_dtype(len(labels)))
+            data[col] = pd.Categorical.from_codes(codes, categories=labels)
+        else:
+            data[col] = np.concatenate([old.to_numpy(), new.to_numpy().astype(old.dtype)])
+    return pd.DataFrame(data, copy=False)
+
+
+def _read_source(path, columns=None):
+    """
+    Reads the up to date snapshot of `path` if there is one (completed with the rows appended to
+    the csv since it was built), the csv otherwise.
+    """
+    meta = read_snapshot_meta(snapshot_path(path))
+    if meta is not None and meta['format'] == SNAPSHOT_FORMAT:
+        version = file_version(path)
+        if tuple(meta['source_version']) == version:
+            return read_snapshot(snapshot_path(path), meta, columns), 'snapshot'
+        batch = read_appended(path, meta['source_version'], version, columns)
+        if batch is not None:
+            return concat_frames(read_snapshot(snapshot_path(path), meta, columns), batch), 'snapshot+appended'
+    return read_survey(path, columns), 'csv'
+
+
+def load_data(path=DATA_PATH, profile=None):
+    """
+    Returns the survey DataFrame, parsed once per process and re-read only when the file changes.
+
+    If an up to date snapshot of the csv exists (see `build_snapshot`) it is memory-mapped instead
+    of parsing the text. When the file only grew by appended batches (see `append_batch`), just
+    the new rows are parsed and added to the cached frame. The frame is a shallow copy of the
+    cached one: with copy-on-write (always on from pandas 3) any change made by the caller is
+    applied to a private copy, the cached data stay untouched.
+
+    :param path: Path of the csv file.
+    :param profile: Load profile (see LOAD_PROFILES), i.e. the columns loaded; default
+                    $STILI_LOAD_PROFILE or 'dashboard', the columns the dashboard reads.
+    """
+    path = os.path.abspath(path)
+    profile = profile or LOAD_PROFILE
+    columns = LOAD_PROFILES[profile]
+    version = file_version(path)
+    with _lock:
+        entry = _cache.get((path, profile))
+        if entry is None or entry['version'] != version:
+            rss_before = rss_bytes()
+            start = time.perf_counter()
+            batch = None if entry is None else read_appended(path, entry['version'], version, columns)
+            if batch is not None:
+                df, source = concat_frames(entry['df'], batch), 'appended'
+            else:
+                df, source = _read_source(path, columns)
+            seconds = time.perf_counter() - start
+            rss_after = rss_bytes()
+            entry = {
+                'version': version,
+                'df': df,
+                'stats': {
+                    'path': path,
+                    'profile': profile,
+                    'source': source,
+                    'rows': len(df),
+                    'load_seconds': seconds,
+                    'frame_bytes': int(df.memory_usage(deep=True).sum()),
+                    'rss_bytes': rss_after,
+                    'rss_delta_bytes': None if rss_before is None else rss_after - rss_before,
+                },
+            }
+            _cache[(path, profile)] = entry
+            logger.info("loaded %s (%s) from %s: %d rows in %.1f ms, frame %.2f MB, rss %.1f MB",
+                        path, profile, source, len(df), seconds * 1000, entry['stats']['frame_bytes'] / 2**20,
+                        (rss_after or 0) / 2**20)
+    return entry['df'].copy(deep=False)
+
+
+def load_stats(path=DATA_PATH, profile=None):
+    """Load time and memory figures of the last load of `path` (None if never loaded)."""
+    entry = _cache.get((os.path.abspath(path), profile or LOAD_PROFILE))
+    return None if entry is None else dict(entry['stats'])
+
+
+def memory_report(path=DATA_PATH, top=5):
+    """
+    Memory of the survey frame parsed untyped (every text column as Python strings), then loaded
+    with each profile of LOAD_PROFILES from the csv and from the snapshot if there is one.
+
+    :return: Report with the bytes of each frame, the `top` largest untyped columns and the
+             reduction factor of each profile over the untyped frame.
+    """
+    raw = normalize(pd.read_csv(path))
+    untyped = raw.memory_usage(deep=True, index=False)
+    report = {
+        'path': os.path.abspath(path),
+        'rows': len(raw),
+        'untyped_bytes': int(untyped.sum()),
+        'untyped_largest_columns': {col: int(size) for col, size in untyped.nlargest(top).items()},
+        'profiles': {},
+    }
+    meta = read_snapshot_meta(snapshot_path(path))
+    for profile, columns in LOAD_PROFILES.items():
+        entry = {'columns': len(columns) if columns else len(untyped),
+                 'csv_frame_bytes': int(read_survey(path, columns).memory_usage(deep=True, index=False).sum())}
+        if meta is not None and meta['format'] == SNAPSHOT_FORMAT:
+            frame = read_snapshot(snapshot_path(path), meta, columns)
+            entry['snapshot_frame_bytes'] = int(frame.memory_usage(deep=True, index=False).sum())
+        entry['reduction'] = round(report['untyped_bytes'] / entry['csv_frame_bytes'], 1)
+        report['profiles'][profile] = entry
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Survey data tools.")
+    parser.add_argument('command', nargs='?', default='report', choices=['report', 'memory', 'snapshot', 'ingest'],
+                        help="report: load time and memory; memory: frame size per load profile; "
+                             "snapshot: build the binary snapshot; ingest: append the respondents of --batch")
+    parser.add_argument('--path', default=DATA_PATH, help="csv file")
+    parser.add_argument('--batch', help="csv file of new respondents (ingest)")
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        if not args.batch:
+            parser.error("ingest needs --batch")
+        start = time.perf_counter()
+        result = append_batch(args.batch, args.path)
+        print(f"appended {result['rows']} rows to {args.path} in {time.perf_counter() - start:.2f} s")
+    elif args.command == 'memory':
+        print(json.dumps(memory_report(args.path), indent=2))
+    elif args.command == 'snapshot':
+        start = time.perf_counter()
+        out_dir = build_snapshot(args.path)
+        print(f"snapshot written to {out_dir} in {time.perf_counter() - start:.2f} s")
+    else:
+        start = time.perf_counter()
+        pd.read_csv(args.path)
+        untyped_seconds = time.perf_counter() - start
+        untyped_bytes = int(normalize(pd.read_csv(args.path)).memory_usage(deep=True).sum())
+
+        load_data(args.path)
+        start = time.perf_counter()
+        load_data(args.path)
+        cached_seconds = time.perf_counter() - start
+
+        report = load_stats(args.path)
+        report.update({
+            'untyped_load_seconds': untyped_seconds,
+            'untyped_frame_bytes': untyped_bytes,
+            'cached_load_seconds': cached_seconds,
+        })
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,278 @@
+"""
+Engine running the dashboard queries as SQL on an embedded DuckDB, over a Parquet copy of the
+used columns of the survey (data/stili_al.parquet/v<version>.parquet).
+
+The Parquet file is written from the csv in chunks (utils_data.read_survey_chunks) the first time
+the engine is built for a version of the data: each chunk goes to a Parquet part file as it is
+read, then the parts are sorted by the filter columns into the copy, the sort spilling to disk
+past $STILI_DUCKDB_MEMORY (default 1GB), so the build never holds the survey in memory either.
+The engine then never loads the survey. Every query is one SQL statement whose filters are
+pushed down to the Parquet scan (row groups and columns not needed are skipped), run by DuckDB on
+all the cores ($STILI_DUCKDB_THREADS to change it).
+
+Optional: needs the duckdb package (pip install duckdb).
+"""
+import os
+import json
+import shutil
+import importlib.util
+import numpy as np
+import pandas as pd
+from utils_data import (DATA_PATH, FILTER_COLUMNS, ANSWER_COLUMNS, FREQ_COLUMNS, CAM_COLUMNS, CATEGORY_COLUMNS,
+                        CHUNK_ROWS, file_version, survey_labels, read_survey_chunks)
+from utils_agg import Aggregator, VALUE_COLUMNS, TOTALS, block_offsets, summary_table
+
+PARQUET_FORMAT = 1
+# Parquet copies kept on a new version: engines still open on the previous one (in other workers,
+# or in this one until load_engine swaps them) read it at every query
+KEEP_VERSIONS = 2
+THREADS = int(os.environ.get('STILI_DUCKDB_THREADS', 0)) or None  # None: DuckDB's default, all the cores
+# memory of the sort of build_parquet, past which DuckDB spills to its temporary directory
+BUILD_MEMORY = os.environ.get('STILI_DUCKDB_MEMORY', '1GB')
+
+# SQL of every kind of TOTALS over a freq_*/cam_* column
+AGGREGATES = {
+    'sums': 'coalesce(sum({col}), 0)',
+    'sizes': 'count({col})',
+    'ups': 'count_if({col} = 1)',
+    'downs': 'count_if({col} = -1)',
+}
+
+
+def available():
+    """Whether the duckdb package is installed."""
+    return importlib.util.find_spec('duckdb') is not None
+
+
+def parquet_dir(path=DATA_PATH):
+    """Directory of the Parquet copies of the survey csv at `path`."""
+    return os.path.splitext(os.path.abspath(path))[0] + '.parquet'
+
+
+def parquet_path(path=DATA_PATH, version=None):
+    """Parquet copy of the csv at `path` for its `version` (default: the current one)."""
+    version = version or file_version(path)
+    return os.path.join(parquet_dir(path), 'v{}_{}.parquet'.format(*version))
+
+
+def _quote(text):
+    """`text` as an SQL string literal."""
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _name(col):
+    return '"' + col.replace('"', '""') + '"'
+
+
+def _connect(threads=THREADS):
+    if not available():
+        raise ImportError("the duckdb engine needs the duckdb package: pip install duckdb")
+    import duckdb
+    return duckdb.connect(config={'threads': threads} if threads else {})
+
+
+def build_parquet(path=DATA_PATH, chunksize=CHUNK_ROWS):
+    """
+    Writes the Parquet copy of the survey csv at `path` (see parquet_path), read `chunksize` rows
+    at a time, and removes the copies of the versions before the last KEEP_VERSIONS. The category
+    labels (in the code order of utils_agg.category_codes) and the filter options are kept in its
+    metadata.
+
+    :return: Path of the Parquet file.
+    """
+    path = os.path.abspath(path)
+    version = file_version(path)
+    out = parquet_path(path, version)
+    labels, first_seen = survey_labels(path, chunksize=chunksize)
+    select = ', '.join([f'{_name(col)}::VARCHAR AS {_name(col)}' for col in CATEGORY_COLUMNS] +
+                       [f'{_name(col)}::DOUBLE AS {_name(col)}' for col in VALUE_COLUMNS])
+    meta = json.dumps({'format': PARQUET_FORMAT, 'version': list(version), 'labels': labels,
+                       'options': {col: first_seen[col] for col in FILTER_COLUMNS}}, ensure_ascii=False)
+    tmp = f'{out}.{os.getpid()}.tmp'
+    parts = f'{out}.{os.getpid()}.parts'  # the unsorted chunks, and the spill files of the sort
+    os.makedirs(parts, exist_ok=True)
+    con = _connect()
+    try:
+        con.execute(f"SET temp_directory = {_quote(parts)}")
+        con.execute(f"SET memory_limit = {_quote(BUILD_MEMORY)}")
+        for i, chunk in enumerate(read_survey_chunks(path, chunksize=chunksize)):
+            con.register('chunk', chunk)
+            part = os.path.join(parts, f'part_{i:05d}.parquet')
+            con.execute(f"COPY (SELECT {select} FROM chunk) TO {_quote(part)} (FORMAT parquet)")
+            con.unregister('chunk')
+        # sorted by the filter columns: the row groups of a country/region have narrow min/max
+        # statistics, and the scans of a filtered query skip the others
+        order = ', '.join(_name(col) for col in FILTER_COLUMNS)
+        scan = _quote(os.path.join(parts, 'part_*.parquet'))
+        con.execute(f"COPY (SELECT * FROM read_parquet({scan}) ORDER BY {order}) TO {_quote(tmp)} "
+                    f"(FORMAT parquet, COMPRESSION zstd, KV_METADATA {{stili: {_quote(meta)}}})")
+    finally:
+        con.close()
+        shutil.rmtree(parts, ignore_errors=True)
+    os.replace(tmp, out)
+    folder = os.path.dirname(out)
+    older = []
+    for name in os.listdir(folder):
+        if name != os.path.basename(out) and name.endswith('.parquet'):
+            try:
+                older.append((os.path.getmtime(os.path.join(folder, name)), name))
+            except FileNotFoundError:  # removed by another worker
+                pass
+    for _, name in sorted(older, reverse=True)[KEEP_VERSIONS - 1:]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+    return out
+
+
+def read_parquet_meta(parquet, con=None):
+    """The metadata written by build_parquet (None if the file is missing or of another format)."""
+    if not os.path.exists(parquet):
+        return None
+    con = con or _connect()
+    rows = con.execute(f"SELECT value FROM parquet_kv_metadata({_quote(parquet)}) WHERE key = 'stili'").fetchall()
+    if not rows:
+        return None
+    meta = json.loads(rows[0][0])
+    return meta if meta.get('format') == PARQUET_FORMAT else None
+
+
+def _where(filters):
+    """SQL WHERE clause and parameters of a filter state (see utils_agg.make_filters)."""
+    clauses, params = [], []
+    for col, values in filters.items():
+        if values is None:
+            continue
+        if not values:
+            clauses.append('false')
+        else:
+            clauses.append(f"{_name(col)} IN ({', '.join('?' * len(values))})")
+            params += list(values)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+class DuckEngine(Aggregator):
+    """
+    The engine primitives (utils_agg.Aggregator) as SQL: the counts of a column (and of a column by
+    a filter column) are a GROUP BY, the freq_*/cam_* totals one aggregate per column, and the
+    answers of all the products one GROUP BY with a grouping set per q4__*/q5__* column. The results are
+    put back in the code order of the labels, so the return shapes are the ones of every engine.
+    """
+
+    def __init__(self, path=DATA_PATH, threads=THREADS):
+        self.con = _connect(threads)
+        self.parquet = parquet_path(path)
+        meta = read_parquet_meta(self.parquet, self.con)
+        if meta is None:
+            build_parquet(path)
+            meta = read_parquet_meta(self.parquet, self.con)
+        self.labels = meta['labels']
+        self.options = meta['options']
+        self._codes = {col: {label: code for code, label in enumerate(labels)} for col, labels in self.labels.items()}
+        self.answer_offsets = block_offsets([len(self.labels[col]) + 1 for col in ANSWER_COLUMNS])
+        self.con.execute(f"CREATE VIEW survey AS SELECT * FROM read_parquet({_quote(self.parquet)})")
+
+    def _query(self, sql, params=()):
+        # one cursor per query: the sessions of a worker query from concurrent threads
+        with self.con.cursor() as cursor:
+            return cursor.execute(sql, list(params)).fetchall()
+
+    def _code(self, col, value):
+        return len(self.labels[col]) if value is None else self._codes[col][value]
+
+    def _counts(self, col, filters, keep=None):
+        where, params = _where(filters)
+        size = len(self.labels[col]) + 1
+        if keep is None:
+            counts = np.zeros(size, dtype=np.int64)
+            for value, n in self._query(f'SELECT {_name(col)}, count(*) FROM survey{where} GROUP BY ALL', params):
+                counts[self._code(col, value)] = n
+            return counts
+        counts = np.zeros((len(self.labels[keep]) + 1, size), dtype=np.int64)
+        sql = f'SELECT {_name(keep)}, {_name(col)}, count(*) FROM survey{where} GROUP BY ALL'
+        for group, value, n in self._query(sql, params):
+            counts[self._code(keep, group), self._code(col, value)] = n
+        return counts
+
+    def _answer_counts(self, columns, filters):
+        """Respondents per code (last slot = missing) of every column in `columns`, in one query."""
+        where, params = _where(filters)
+        names = [_name(col) for col in columns]
+        n = len(columns)
+        # one grouping set per column: grouping(col) is 0 on the rows of its own set
+        sql = (f"SELECT {', '.join(f'grouping({name})' for name in names)}, {', '.join(names)}, count(*) "
+               f"FROM survey{where} GROUP BY GROUPING SETS ({', '.join(f'({name})' for name in names)})")
+        counts = [np.zeros(len(self.labels[col]) + 1, dtype=np.int64) for col in columns]
+        for row in self._query(sql, params):
+            j = row[:n].index(0)
+            counts[j][self._code(columns[j], row[n + j])] = row[-1]
+        return counts
+
+    def _totals(self, filters, cells):
+        """
+        value_totals of the rows accepted by `filters`, as a (TOTALS x VALUE_COLUMNS) array: the
+        (kind, column) `cells` are computed in one query, the others are left at 0.
+        """
+        where, params = _where(filters)
+        select = ', '.join(AGGREGATES[kind].format(col=_name(col)) for kind, col in cells)
+        totals = np.zeros((len(TOTALS), len(VALUE_COLUMNS)))
+        for (kind, col), value in zip(cells, self._query(f'SELECT {select} FROM survey{where}', params)[0]):
+            totals[TOTALS.index(kind), VALUE_COLUMNS.index(col)] = value
+        return totals
+
+    def _total(self, kind, col, filters):
+        return self._totals(filters, [(kind, col)])[TOTALS.index(kind), VALUE_COLUMNS.index(col)]
+
+    def _product_totals(self, filters):
+        # product_summary reads the sums and sizes of the freq_* columns and the ups and downs of
+        # the cam_* ones: the other totals are not computed
+        cells = ([(kind, col) for kind in ('sums', 'sizes') for col in FREQ_COLUMNS] +
+                 [(kind, col) for kind in ('ups', 'downs') for col in CAM_COLUMNS])
+        return np.concatenate(self._answer_counts(ANSWER_COLUMNS, filters)), self._totals(filters, cells)
+
+    def category_table(self, filters, categories=['regione', 'sesso', 'generazione']) -> pd.DataFrame:
+        """
+        Like utils_agg.aggregate_dataframe(filter_df(df, filters), categories=categories): the
+        stile totals and the stile x category counts in one query, a grouping set each.
+        """
+        where, params = _where(filters)
+        names = [_name(category) for category in categories]
+        k = len(categories)
+        select = [f'grouping({name})' for name in names] + ['stile'] + names + ['count(*)']
+        sets = ['(stile)'] + [f'(stile, {name})' for name in names]
+        sql = f"SELECT {', '.join(select)} FROM survey{where} GROUP BY GROUPING SETS ({', '.join(sets)})"
+        n_stile = len(self.labels['stile']) + 1
+        total = np.zeros(n_stile, dtype=np.int64)
+        tables = [np.zeros((n_stile, len(self.labels[category]) + 1), dtype=np.int64) for category in categories]
+        for row in self._query(sql, params):
+            stile = self._code('stile', row[k])
+            if 0 in row[:k]:
+                j = row[:k].index(0)
+                tables[j][stile, self._code(categories[j], row[k + 1 + j])] = row[-1]
+            else:
+                total[stile] = row[-1]
+        return summary_table(self.labels['stile'], total,
+                             [(self.labels[category], table) for category, table in zip(categories, tables)])
+
+    def answer_counts(self, filters, columns) -> list:
+        """Like utils_agg.answer_counts(filter_df(df, filters), columns)."""
+        series_list = []
+        for col, counts in zip(columns, self._answer_counts(columns, filters)):
+            s = pd.Series(counts[:-1], index=pd.Index(self.labels[col], name=col), name='count')
+            series_list.append(s.sort_values(ascending=False, kind='stable'))
+        return series_list
+
+    def mean_values(self, filters, columns) -> dict:
+        """Like utils_agg.mean_values(filter_df(df, filters), columns)."""
+        totals = self._totals(filters, [(kind, col) for kind in ('sums', 'sizes') for col in columns])
+        j = [VALUE_COLUMNS.index(col) for col in columns]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return dict(zip(columns, totals[TOTALS.index('sums'), j] / totals[TOTALS.index('sizes'), j]))
+
+    def growth_rates(self, filters, columns) -> dict:
+        """Like utils_agg.growth_rates(filter_df(df, filters), columns)."""
+        totals = self._totals(filters, [(kind, col) for kind in ('ups', 'downs') for col in columns])
+        j = [VALUE_COLUMNS.index(col) for col in columns]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return dict(zip(columns, (totals[TOTALS.index('ups'), j] / totals[TOTALS.index('downs'), j] - 1) * 100))
@@ -0,0 +1,158 @@
+import os
+import logging
+import threading
+import pandas as pd
+from utils_data import DATA_PATH, file_version, load_data, read_appended
+from utils_agg import PandasEngine, filters_key
+from utils_cache import result_cache
+from utils_cube import Cube
+from utils_index import IndexedSurvey
+from utils_duck import DuckEngine
+
+logger = logging.getLogger(__name__)
+
+# engine answering the dashboard queries, all with the same methods and return shapes:
+# - cube: precomputed counts over the filter combinations (utils_cube)
+# - index: bitmap index over the rows + aggregation of their codes (utils_index)
+# - pandas: filter and group the DataFrame (utils_agg, reference implementation)
+ENGINES = {
+    'cube': Cube,
+    'index': IndexedSurvey,
+    'pandas': PandasEngine,
+}
+# engines built from the csv itself, streamed in chunks, instead of the loaded DataFrame:
+# - stream: the cube, for data files larger than memory (Cube.from_csv)
+# - duckdb: SQL on an embedded DuckDB over a Parquet copy of the csv (utils_duck, needs duckdb)
+STREAMED_ENGINES = {
+    'stream': Cube.from_csv,
+    'duckdb': DuckEngine,
+}
+ENGINE = os.environ.get('STILI_ENGINE', 'cube')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def load_engine(name=None, path=DATA_PATH):
+    """
+    The engine `name` (default: $STILI_ENGINE or 'cube') over the survey data at `path`,
+    built once per process and version of the file. When the file changed by appended batches
+    only (utils_data.append_batch), the new rows are added to the engine built for the previous
+    version (see Cube.extend, IndexedSurvey.extend) instead of building it again. The engines
+    are swapped under the lock: queries see either the old or the new data, never a mix.
+    The engines of STREAMED_ENGINES read the file themselves, without loading the DataFrame.
+    """
+    name = name or ENGINE
+    if name not in ENGINES and name not in STREAMED_ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of {list(ENGINES) + list(STREAMED_ENGINES)}")
+    path = os.path.abspath(path)
+    version = file_version(path)
+    with _lock:
+        entry = _cache.get((name, path))
+        if entry is None or entry[0] != version:
+            engine = None
+            if entry is not None and hasattr(entry[1], 'extend'):
+                # the file only grew by appended batches: add their rows to the current engine
+                batch = read_appended(path, entry[0], version)
+                if batch is not None:
+                    engine = entry[1].extend(batch)
+            if engine is None:
+                engine = STREAMED_ENGINES[name](path) if name in STREAMED_ENGINES else ENGINES[name](load_data(path))
+            entry = (version, engine)
+            _cache[(name, path)] = entry
+    return entry[1]
+
+
+# version of the return shapes of the engine methods: results stored in a utils_store.ResultStore
+# under another format are never read. Bump it whenever a cached method returns something else.
+RESULT_FORMAT = 1
+
+
+# type of the result of every cached method: a stored result of another type is not served
+RESULT_TYPES = {
+    'n_rows': int,
+    'stile_counts': pd.Series,
+    'stile_counts_by': pd.Series,
+    'stile_matrix': pd.DataFrame,
+    'category_table': pd.DataFrame,
+    'answer_counts': list,
+    'mean_values': dict,
+    'growth_rates': dict,
+    'product_stats': dict,
+}
+
+
+def query_key(name, method, filters, *args):
+    """Key of the result of engine `name`.`method`(filters, *args) in a utils_store.ResultStore."""
+    return (RESULT_FORMAT, name, method, filters_key(filters)) + args
+
+
+class CachedEngine:
+    """
+    The engine `name` over `path` behind the process-wide `cache` of query results: sessions asking
+    for the same filter state (utils_agg.filters_key) and arguments share one computation, until
+    the data file changes. On a miss, the result is read from `store` (a utils_store.ResultStore
+    shared by the workers of the machine and filled ahead of time) if it has it, otherwise it is
+    computed and written to the store for the other workers and the next restarts.
+    """
+
+    def __init__(self, name=None, path=DATA_PATH, cache=result_cache, store=None):
+        self.name = name or ENGINE
+        self.path = os.path.abspath(path)
+        self.cache = cache
+        self.store = store
+        load_engine(self.name, self.path)  # fail early on an unknown engine
+
+    @property
+    def options(self):
+        return load_engine(self.name, self.path).options
+
+    def _query(self, method, filters, *args):
+        scope = (self.name, self.path)
+        version = file_version(self.path)
+        self.cache.check_version(scope, version)
+        key = (scope, version, method, filters_key(filters)) + args
+        return self.cache.get_or_compute(key, lambda: self._compute(version, method, filters, args))
+
+    def _compute(self, version, method, filters, args):
+        if self.store is None:
+            return getattr(load_engine(self.name, self.path), method)(filters, *args)
+        key = query_key(self.name, method, filters, *args)
+        value = self.store.get(version, key)
+        if value is not None and not isinstance(value, RESULT_TYPES[method]):
+            # stored by code returning another shape under the same RESULT_FORMAT: computed again
+            # and overwritten
+            logger.warning("result store: dropping a %s result of %s", type(value).__name__, method)
+            value = None
+        if value is None:
+            value = getattr(load_engine(self.name, self.path), method)(filters, *args)
+            self.store.put(version, key, value)
+        return value
+
+    def n_rows(self, filters):
+        return self._query('n_rows', filters)
+
+    def stile_counts(self, filters):
+        return self._query('stile_counts', filters)
+
+    def stile_counts_by(self, filters, compare_by):
+        return self._query('stile_counts_by', filters, compare_by)
+
+    def stile_matrix(self, filters, compare_by):
+        return self._query('stile_matrix', filters, compare_by)
+
+    def category_table(self, filters, categories=('regione', 'sesso', 'generazione')):
+        # the order of the categories is the order of the table columns: it is part of the key
+        return self._query('category_table', filters, tuple(categories))
+
+    def answer_counts(self, filters, columns):
+        return self._query('answer_counts', filters, tuple(columns))
+
+    def mean_values(self, filters, columns):
+        return self._query('mean_values', filters, tuple(columns))
+
+    def growth_rates(self, filters, columns):
+        return self._query('growth_rates', filters, tuple(columns))
+
+    def product_stats(self, filters):
+        return self._query('product_stats', filters)
@@ -0,0 +1,160 @@
+import copy
+import numpy as np
+import pandas as pd
+from utils_data import FILTER_COLUMNS, ANSWER_COLUMNS
+from utils_agg import (Aggregator, VALUE_COLUMNS, category_codes, label_codes, block_offsets, stile_crosstabs,
+                       summary_table, value_totals)
+
+
+class BitmapIndex:
+    """
+    One packed bitset (np.packbits) per value of each filter column, built once at load.
+
+    A filter state resolves by OR-ing the bitsets of the accepted values of a column and AND-ing
+    the columns together: no expression is evaluated and no DataFrame is copied.
+    """
+
+    def __init__(self, df, columns=FILTER_COLUMNS):
+        self._build({col: category_codes(df[col]) for col in columns}, len(df))
+
+    @classmethod
+    def from_codes(cls, codes, n_rows):
+        """Index over already encoded columns: `codes` maps each column to (codes, labels)."""
+        index = cls.__new__(cls)
+        index._build(codes, n_rows)
+        return index
+
+    def _build(self, codes, n_rows):
+        self.n_rows = n_rows
+        self.bitsets = {}  # column -> {label: packed bits}
+        for col, (col_codes, labels) in codes.items():
+            self.bitsets[col] = {label: np.packbits(col_codes == code) for code, label in enumerate(labels)}
+        self._all = np.arange(self.n_rows)
+
+    def nbytes(self):
+        return sum(bits.nbytes for col in self.bitsets.values() for bits in col.values())
+
+    def mask(self, filters):
+        """Packed bits of the rows accepted by `filters` (None when nothing is filtered)."""
+        mask = None
+        owned = False  # whether `mask` is a fresh buffer, not one of the index bitsets
+        for col, values in filters.items():
+            if values is None:
+                continue
+            bitsets = [self.bitsets[col][value] for value in values if value in self.bitsets[col]]
+            if len(bitsets) == 1:
+                col_mask, col_owned = bitsets[0], False
+            elif bitsets:
+                col_mask, col_owned = np.bitwise_or.reduce(bitsets), True
+            else:
+                col_mask, col_owned = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8), True
+            if mask is None:
+                mask, owned = col_mask, col_owned
+            elif owned:
+                mask &= col_mask
+            else:
+                mask, owned = mask & col_mask, True
+        return mask
+
+    def rows(self, filters) -> np.ndarray:
+        """Positions of the rows accepted by `filters` (see utils_agg.make_filters)."""
+        mask = self.mask(filters)
+        if mask is None:
+            return self._all
+        nonzero = np.flatnonzero(mask)
+        if len(nonzero) > len(mask) // 4:
+            return np.flatnonzero(np.unpackbits(mask, count=self.n_rows))
+        # selective filter: unpack only the non empty bytes
+        bits = np.unpackbits(mask[nonzero]).reshape(-1, 8).view(bool)
+        rows = (nonzero[:, None] * 8 + np.arange(8))[bits]
+        return rows[rows < self.n_rows]
+
+
+class IndexedSurvey(Aggregator):
+    """
+    Engine that filters with a BitmapIndex and aggregates the integer codes of the selected rows.
+
+    Only the final aggregation reads the data, at the row positions given by the index. The
+    product columns are kept as row-major matrices (`answers`: the q4__*/q5__* codes shifted to
+    their block at `answer_offsets`; `values`: the VALUE_COLUMNS), so the statistics of all the
+    products come from one gather of the selected rows.
+    """
+
+    def __init__(self, df):
+        self.index = BitmapIndex(df)
+        self.labels = {}
+        self.codes = {}
+        for col in FILTER_COLUMNS + ['stile']:
+            self.codes[col], self.labels[col] = category_codes(df[col])
+        self.options = {col: [self.labels[col][code] for code in pd.unique(self.codes[col])
+                              if code < len(self.labels[col])]
+                        for col in FILTER_COLUMNS}
+        codes_list = []
+        for col in ANSWER_COLUMNS:
+            codes, self.labels[col] = category_codes(df[col])
+            codes_list.append(codes)
+        widths = [len(self.labels[col]) + 1 for col in ANSWER_COLUMNS]
+        self.answer_offsets = block_offsets(widths)
+        self.n_answer_codes = sum(widths)
+        dtype = np.int16 if self.n_answer_codes <= np.iinfo(np.int16).max else np.int64
+        self.answers = (np.column_stack(codes_list) + self.answer_offsets).astype(dtype)
+        self.values = df[VALUE_COLUMNS].to_numpy(dtype=np.float64)
+
+    def extend(self, df):
+        """
+        A new IndexedSurvey with the respondents of `df` after the ones of this one, which is left
+        untouched. None if `df` has a category not in the labels (the engine must be rebuilt).
+        """
+        codes = {}
+        for col in list(self.codes) + ANSWER_COLUMNS:
+            codes[col] = label_codes(df[col], self.labels[col])
+            if codes[col] is None:
+                return None
+        survey = copy.copy(self)
+        survey.codes = {col: np.concatenate([self.codes[col], codes[col]]) for col in self.codes}
+        answers = np.column_stack([codes[col] for col in ANSWER_COLUMNS]) + self.answer_offsets
+        survey.answers = np.concatenate([self.answers, answers.astype(self.answers.dtype)])
+        survey.values = np.concatenate([self.values, df[VALUE_COLUMNS].to_numpy(dtype=np.float64)])
+        survey.index = BitmapIndex.from_codes({col: (survey.codes[col], self.labels[col]) for col in FILTER_COLUMNS},
+                                              len(survey.values))
+        return survey
+
+    def _column_codes(self, col, rows):
+        if col in self.codes:
+            return self.codes[col][rows]
+        j = ANSWER_COLUMNS.index(col)
+        return self.answers[rows, j].astype(np.int64) - self.answer_offsets[j]
+
+    def _counts(self, col, filters, keep=None):
+        rows = self.index.rows(filters)
+        size = len(self.labels[col]) + 1
+        codes = self._column_codes(col, rows)
+        if keep is None:
+            return np.bincount(codes, minlength=size)
+        keep_size = len(self.labels[keep]) + 1
+        combined = self.codes[keep][rows] * size + codes
+        return np.bincount(combined, minlength=keep_size * size).reshape(keep_size, size)
+
+    def _total(self, kind, col, filters):
+        values = self.values[self.index.rows(filters), VALUE_COLUMNS.index(col)]
+        if kind == 'sums':
+            return np.nansum(values)
+        if kind == 'sizes':
+            return np.count_nonzero(~np.isnan(values))
+        return np.count_nonzero(values == (1 if kind == 'ups' else -1))
+
+    def _product_totals(self, filters):
+        rows = self.index.rows(filters)
+        counts = np.bincount(self.answers[rows].ravel(), minlength=self.n_answer_codes)
+        return counts, value_totals(self.values[rows])
+
+    def category_table(self, filters, categories=['regione', 'sesso', 'generazione']):
+        """Like utils_agg.aggregate_dataframe(filter_df(df, filters), categories=categories)."""
+        rows = self.index.rows(filters)
+        stile_codes = self.codes['stile'][rows]
+        n_stile = len(self.labels['stile'])
+        total = np.bincount(stile_codes, minlength=n_stile + 1)
+        tables = stile_crosstabs(stile_codes, n_stile, [self.codes[category][rows] for category in categories],
+                                 [len(self.labels[category]) for category in categories])
+        return summary_table(self.labels['stile'], total,
+                             [(self.labels[category], table) for category, table in zip(categories, tables)])
@@ -0,0 +1,274 @@
+"""
+Performance reports and instrumentation of the dashboard.
+
+    python utils_perf.py [--imports] [--first-run] [--tree MODULE]
+
+--imports prints the import time of the modules the dashboard loads, each on top of the ones
+before it, in fresh interpreters; --first-run adds the time of a first, cold run of
+dashboard.py (module imports + data/engine load + first render) in a new process; --tree
+lists the slowest modules (self time) pulled in by one import.
+
+RerunTrace records the stages of each rerun of the page (see dashboard.py): a timing span and
+the resident memory delta of each stage, with the filter state. Every finished trace is logged
+as one JSON line (logger utils_perf), added to the process-wide `stage_metrics` and, when
+$STILI_METRICS_FILE is set, dumped in the Prometheus text format to one file per process next to
+it (see metrics_path), at most every $STILI_METRICS_INTERVAL seconds.
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+from contextlib import contextmanager
+from utils_data import rss_bytes, atomic_write
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Prometheus text dump of stage_metrics (e.g. for the textfile collector), one file per process
+# (see metrics_path), rewritten after a rerun if the last dump is older than METRICS_INTERVAL seconds
+METRICS_FILE = os.environ.get('STILI_METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('STILI_METRICS_INTERVAL', 10))
+
+# what a worker imports to serve the page, and the heavy libraries it may or may not need
+IMPORT_MODULES = [
+    'streamlit', 'pandas', 'numpy', 'utils_data', 'utils_agg', 'utils_engine', 'utils_plot', 'utils_vega',
+    'dashboard_deps', 'matplotlib.pyplot', 'plotly.graph_objects', 'plotly.express', 'altair',
+]
+
+_IMPORTTIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+\d+\s+\|\s*(\S+)')
+
+
+def import_times(modules, python=sys.executable):
+    """
+    Import time in ms of each of `modules` on top of the ones listed before it, each measured in
+    a fresh interpreter (a module already pulled in by a previous one costs ~0).
+
+    'dashboard_deps' stands for the imports of dashboard.py without running the page.
+    """
+    statements = []
+    for module in modules:
+        if module == 'dashboard_deps':
+            statements.append('import utils_plot, utils_vega, utils_engine, utils_agg, utils_contstants')
+        else:
+            statements.append(f'import {module}')
+    times = {}
+    for module, statement in zip(modules, statements):
+        before = '; '.join(statements[:modules.index(module)])
+        code = f"{before}\nimport time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+        out = subprocess.run([python, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times[module] = round(float(out.stdout.strip().splitlines()[-1]) * 1000, 1)
+    return times
+
+
+def import_tree(module, python=sys.executable, top=15):
+    """The `top` slowest modules (self time, ms) when importing `module` in a fresh interpreter."""
+    out = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            rows.append((match.group(2), int(match.group(1)) / 1000))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return {name: round(ms, 1) for name, ms in rows[:top]}
+
+
+def first_run_seconds(script='dashboard.py', python=sys.executable, timeout=300):
+    """Wall time of a first run of the Streamlit `script` (AppTest) in a new process."""
+    code = (
+        "import time; t = time.perf_counter()\n"
+        "from streamlit.testing.v1 import AppTest\n"
+        f"at = AppTest.from_file({os.path.join(ROOT, script)!r}, default_timeout={timeout})\n"
+        "at.run()\n"
+        "assert not at.exception, at.exception\n"
+        "print(time.perf_counter() - t)"
+    )
+    out = subprocess.run([python, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return round(float(out.stdout.strip().splitlines()[-1]), 2)
+
+
+#######################
+# Rerun instrumentation
+class RerunTrace:
+    """
+    Timing spans of the stages of one rerun. A span costs a couple of perf_counter calls and two
+    reads of /proc/self/statm, so the tracing stays on in production.
+
+    A partial rerun (a fragment of the page rerunning alone, page 'dashboard/<fragment>') has the
+    time of the full rerun it replaces as `baseline_ms`: the record reports the time saved.
+    """
+
+    def __init__(self, page='dashboard', baseline_ms=None):
+        self.page = page
+        self.baseline_ms = baseline_ms
+        self.filters = None
+        self.spans = []  # (stage, ms, rss delta in bytes)
+        self._start = time.perf_counter()
+        self.total_ms = None
+
+    @contextmanager
+    def span(self, stage):
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            rss_after = rss_bytes()
+            self.spans.append((stage, ms, None if rss_before is None else rss_after - rss_before))
+
+    def stages(self):
+        """{stage: {'calls', 'ms', 'rss_delta_bytes'}}, summed over the spans of each stage, in order."""
+        stages = {}
+        for stage, ms, rss_delta in self.spans:
+            entry = stages.setdefault(stage, {'calls': 0, 'ms': 0.0, 'rss_delta_bytes': 0})
+            entry['calls'] += 1
+            entry['ms'] += ms
+            entry['rss_delta_bytes'] += rss_delta or 0
+        return stages
+
+    def record(self):
+        """JSON-ready record of the rerun: page, filters, total and per-stage timings."""
+        total_ms = self.total_ms if self.total_ms is not None else (time.perf_counter() - self._start) * 1000
+        record = {'event': 'rerun', 'page': self.page, 'filters': self.filters, 'total_ms': round(total_ms, 3),
+                  'stages': {stage: dict(entry, ms=round(entry['ms'], 3)) for stage, entry in self.stages().items()}}
+        if self.baseline_ms is not None:
+            record['saved_ms'] = round(self.baseline_ms - total_ms, 3)
+        return record
+
+    def finish(self, metrics=None):
+        """Ends the rerun: logs its record, adds it to `metrics` (default stage_metrics) and dumps them."""
+        self.total_ms = (time.perf_counter() - self._start) * 1000
+        metrics = stage_metrics if metrics is None else metrics
+        metrics.add(self)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(self.record(), ensure_ascii=False))
+        if METRICS_FILE:
+            metrics.dump(metrics_path())
+
+
+def metrics_path(path=METRICS_FILE, pid=None):
+    """
+    File of the metrics of the process `pid` (default: this one) for $STILI_METRICS_FILE=`path`:
+    the pid goes before the extension (stili.prom -> stili.<pid>.prom), so the workers of a
+    deployment write side by side instead of over each other, and the .prom files are all read by
+    the textfile collector.
+    """
+    base, ext = os.path.splitext(path)
+    return f'{base}.{pid or os.getpid()}{ext}'
+
+
+class StageMetrics:
+    """
+    Totals of the reruns of the process, per page (full reruns and each kind of partial rerun:
+    count, seconds and seconds saved) and per stage (summary: count, sum and max of the seconds).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.pages = {}   # page -> [reruns, seconds, seconds saved]
+        self.stages = {}  # stage -> [count, seconds, max seconds]
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._dumped = None  # clock time of the last dump
+        self._dump_lock = threading.Lock()
+
+    @property
+    def reruns(self):
+        return sum(entry[0] for entry in self.pages.values())
+
+    def add(self, trace):
+        with self._lock:
+            entry = self.pages.setdefault(trace.page, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += trace.total_ms / 1000
+            if trace.baseline_ms is not None:
+                entry[2] += (trace.baseline_ms - trace.total_ms) / 1000
+            for stage, ms, _ in trace.spans:
+                entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += ms / 1000
+                entry[2] = max(entry[2], ms / 1000)
+
+    def pages_table(self):
+        """{page: {'reruns', 'mean_ms', 'saved_ms'}}: saved_ms is the total saved by the partial reruns."""
+        with self._lock:
+            return {page: {'reruns': count, 'mean_ms': round(seconds / count * 1000, 3),
+                           'saved_ms': round(saved * 1000, 3)}
+                    for page, (count, seconds, saved) in self.pages.items()}
+
+    def table(self):
+        """{stage: {'count', 'mean_ms', 'max_ms'}}."""
+        with self._lock:
+            return {stage: {'count': count, 'mean_ms': round(seconds / count * 1000, 3),
+                            'max_ms': round(max_seconds * 1000, 3)}
+                    for stage, (count, seconds, max_seconds) in self.stages.items()}
+
+    def prometheus_text(self, pid=None):
+        """The totals in the Prometheus text exposition format, with a `pid` label if given."""
+        extra = f',pid="{pid}"' if pid is not None else ''
+        with self._lock:
+            lines = ['# HELP stili_rerun_seconds Time of the reruns of the dashboard (page/fragment).',
+                     '# TYPE stili_rerun_seconds summary']
+            for page, (count, seconds, _) in self.pages.items():
+                lines += [f'stili_rerun_seconds_sum{{page="{page}"{extra}}} {seconds:.6f}',
+                          f'stili_rerun_seconds_count{{page="{page}"{extra}}} {count}']
+            lines += ['# HELP stili_rerun_saved_seconds_total Time saved by partial reruns over full ones.',
+                      '# TYPE stili_rerun_saved_seconds_total counter']
+            lines += [f'stili_rerun_saved_seconds_total{{page="{page}"{extra}}} {saved:.6f}'
+                      for page, (_, _, saved) in self.pages.items()]
+            lines += ['# HELP stili_stage_seconds Time of the stages of the reruns.',
+                      '# TYPE stili_stage_seconds summary']
+            for stage, (count, seconds, _) in self.stages.items():
+                lines += [f'stili_stage_seconds_sum{{stage="{stage}"{extra}}} {seconds:.6f}',
+                          f'stili_stage_seconds_count{{stage="{stage}"{extra}}} {count}']
+            lines += ['# HELP stili_stage_max_seconds Slowest span of each stage.',
+                      '# TYPE stili_stage_max_seconds gauge']
+            lines += [f'stili_stage_max_seconds{{stage="{stage}"{extra}}} {max_seconds:.6f}'
+                      for stage, (_, _, max_seconds) in self.stages.items()]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, interval=METRICS_INTERVAL):
+        """
+        Writes prometheus_text (labelled with the pid of the process) to `path`, unless the last
+        dump is less than `interval` seconds old. Returns whether it was written.
+        """
+        with self._dump_lock:
+            now = self._clock()
+            if self._dumped is not None and now - self._dumped < interval:
+                return False
+            atomic_write(path, self.prometheus_text(pid=os.getpid()).encode())
+            self._dumped = now
+            return True
+
+
+# stages of the reruns of the dashboard in this process
+stage_metrics = StageMetrics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--imports', action='store_true', help='import time of the dashboard modules')
+    parser.add_argument('--first-run', action='store_true', help='time of a cold first run of the page')
+    parser.add_argument('--tree', metavar='MODULE', help='slowest modules pulled in by MODULE')
+    args = parser.parse_args()
+    if not (args.imports or args.first_run or args.tree):
+        parser.error('nothing to report: use --imports, --first-run or --tree MODULE')
+
+    report = {}
+    if args.imports:
+        report['imports_ms'] = import_times(IMPORT_MODULES)
+    if args.tree:
+        report['tree_ms'] = import_tree(args.tree)
+    if args.first_run:
+        report['first_run_s'] = first_run_seconds()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
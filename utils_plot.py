@@ -1,19 +1,73 @@
-import matplotlib.pyplot as plt
+import io
+import hashlib
+import warnings
+import threading
+from typing import NamedTuple
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-from utils_contstants import *
+from utils_contstants import BLUE, CYAN, GREEN, YELLOW, RED, OLIVE, PURPLE, GOLD, COLORS
 
-colors = [ BLUE, CYAN, GREEN, RED, YELLOW, OLIVE, PURPLE, GOLD]
+# matplotlib and plotly are imported on first use, inside the functions that need them: they are
+# the slowest imports of a cold worker and a page may not need them at all. The charts are drawn
+# on matplotlib.figure.Figure objects, not through pyplot and its global figure registry, and
+# their colors come from the `theme` of each call: sessions can render on concurrent threads.
+# The product labels start with emojis the default matplotlib font does not have: the drawing
+# warns once per glyph and chart.
+warnings.filterwarnings('ignore', message='Glyph .* missing from font')
 
-def plot_vertical_bar_chart(series_list, order, title, labels=None, xlabel_rotation=90):
+
+class Theme(NamedTuple):
+    """Colors of the series of a chart, in order. Immutable: one theme can be shared by threads."""
+    colors: tuple = tuple(COLORS)
+
+    def with_first(self, color):
+        """The theme with `color` moved first (the series color picked in the sidebar)."""
+        if color not in self.colors:
+            return self
+        return Theme((color,) + tuple(c for c in self.colors if c != color))
+
+
+DEFAULT_THEME = Theme()
+
+
+def bar_widths(series_list, order) -> np.ndarray:
+    """
+    (series x order) float matrix of the bars of a chart, bars missing from a series = 0.
+
+    :param series_list: List of pd.Series, or a pd.DataFrame with one row per series (e.g.
+                        utils_agg.stile_matrix): reindexed in one step, whatever the number of rows.
+    """
+    if isinstance(series_list, pd.DataFrame):
+        return series_list.reindex(columns=order, fill_value=0).to_numpy(dtype=np.float64)
+    widths = np.vstack([series.reindex(order).to_numpy(dtype=np.float64) for series in series_list])
+    return np.nan_to_num(widths)
+
+
+def bar_percentages(widths) -> np.ndarray:
+    """Share in % of every bar in the total of its series (row of `widths`)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return widths / widths.sum(axis=1, keepdims=True) * 100
+
+
+def series_labels(series_list, labels=None):
+    """`labels`, or the row names of a DataFrame, or "Series <i>"."""
+    if labels is not None:
+        return labels
+    if isinstance(series_list, pd.DataFrame):
+        return [str(name) for name in series_list.index]
+    return [f"Series {i+1}" for i in range(len(series_list))]
+
+
+def plot_vertical_bar_chart(series_list, order, title, labels=None, xlabel_rotation=90, theme=DEFAULT_THEME):
     """
     Plots multiple pd.Series on the same vertical bar chart.
 
     :param series_list: List of pd.Series to plot.
     :param labels: Optional list of labels for the series. If None, Series names will be used.
+    :param theme: Theme of the series colors.
     """
+    from matplotlib.figure import Figure
     n = len(series_list)  # Number of series
     if labels is None:
         labels = [f"Series {i+1}" for i in range(n)]  # Default labels if none provided
@@ -26,10 +80,11 @@ def plot_vertical_bar_chart(series_list, order, title, labels=None, xlabel_rotat
     index = np.arange(len(order))  # Use the provided order for the x-axis
 
     # Plotting
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.subplots()
     for i, (series, label) in enumerate(zip(reordered_series_list, labels)):
         position = index - 0.4 + bar_width*(i + 0.5)
-        bars = ax.bar(position, series, bar_width, label=label, color=colors[i])
+        bars = ax.bar(position, series, bar_width, label=label, color=theme.colors[i])
 
         # Add percentages above bars
         for bar, value in zip(bars, series):
@@ -48,20 +103,27 @@ def plot_vertical_bar_chart(series_list, order, title, labels=None, xlabel_rotat
     ax.set_title(title, fontsize=20)
     ax.legend()
 
-    plt.xticks(rotation=xlabel_rotation)
+    ax.tick_params(axis='x', labelrotation=xlabel_rotation)
 
     return fig
 
 def plot_horizontal_bar_chart(series_list, order, title, figsize=(6, 6), perc_fontsize=10,
-                              labels=None, show_legend=True, show_title=True):
+                              labels=None, show_legend=True, show_title=True, theme=DEFAULT_THEME):
     """
     Plots multiple pd.Series on the same horizontal bar chart.
 
-    :param series_list: List of pd.Series to plot.
+    :param series_list: List of pd.Series to plot, or a pd.DataFrame with one row per series
+                        (the comparison charts, see utils_agg.stile_matrix).
     :param order: The order of the bars on the y-axis.
     :param title: The title of the plot.
     :param labels: Optional list of labels for the series. If None, Series names will be used.
+    :param theme: Theme of the series colors, used in turn when there are more series than colors.
+
+    The percentages are computed and placed with array operations, but each one is still its own
+    text artist: matplotlib has no batched text artist (Axes.bar_label makes one annotation per
+    bar too, and cannot right-align the labels drawn inside the bars).
     """
+    from matplotlib.figure import Figure
     n = len(series_list)  # Number of series
     # control fontsize of the percentage on bars:
     if n == 2:
@@ -70,31 +132,35 @@ def plot_horizontal_bar_chart(series_list, order, title, figsize=(6, 6), perc_fo
         perc_fontsize = 3
     if n > 3:
         perc_fontsize = 1
-    if labels is None:
-        labels = [f"Series {i+1}" for i in range(n)]  # Default labels if none provided
+    labels = series_labels(series_list, labels)
 
-    reordered_series_list = [series.reindex(order) for series in series_list]
-    total_values = [sum(series.values) for series in reordered_series_list]  # Total values for each series
+    # Bar widths as a (series x order) matrix: bars missing from a series are 0
+    widths = bar_widths(series_list, order)
 
     # Settings
     bar_height = 0.8 / n  # Adjust bar height based on number of series
     index = np.arange(len(order))  # Use the provided order for the y-axis
+    positions = index - 0.4 + bar_height * (np.arange(n)[:, None] + 0.5)
+
+    # Percentages and their placement as (series x order) arrays:
+    # inside the bar if the bar is wide enough, otherwise outside
+    percentages = np.char.add(np.char.mod('%.1f', bar_percentages(widths)), '%')
+    inside = widths > 90
+    text_x = np.where(inside, widths - 5, widths + 5)
+    text_ha = np.where(inside, 'right', 'left')
+    text_color = np.where(inside, 'white', 'black')
 
     # Plotting
-    fig, ax = plt.subplots(figsize=figsize)
-    for i, (series, label) in enumerate(zip(reordered_series_list, labels)):
-        position = index - 0.4 + bar_height * (i + 0.5)
-        bars = ax.barh(position, series, bar_height, label=label, color=colors[i])
-       
-        # Add percentages beside bars
-        for bar, value in zip(bars, series):
-            percentage = f"{value / total_values[i] * 100:.1f}%"
-            # Place text inside the bar if the bar is wide enough, otherwise place it outside
-            text_position = bar.get_width() - 5 if bar.get_width() > 90 else bar.get_width() + 5
-            ha = 'right' if bar.get_width() > 90 else 'left'
-            
-            ax.text(text_position, bar.get_y() + bar.get_height() / 2, percentage, 
-                    ha=ha, va='center', color='white' if bar.get_width() > 90 else 'black', fontsize=perc_fontsize)
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots()
+    for i, label in enumerate(labels[:n]):
+        ax.barh(positions[i], widths[i], bar_height, label=label,
+                color=theme.colors[i % len(theme.colors)])
+
+    # Add percentages beside bars, one text per bar
+    for x, y, text, ha, color in zip(text_x.ravel().tolist(), positions.ravel().tolist(), percentages.ravel().tolist(),
+                                     text_ha.ravel().tolist(), text_color.ravel().tolist()):
+        ax.text(x, y, text, ha=ha, va='center', color=color, fontsize=perc_fontsize)
 
     # Remove spines
     ax.spines[['top','right','bottom']].set_visible(False)
@@ -126,6 +192,7 @@ def plot_horizontal_bar_chart(series_list, order, title, figsize=(6, 6), perc_fo
 
 ########## GAUGE
 def plot_gauge(value, color, limit_down=0, limit_up=10, perc=False, title="Volte al mese"):
+    import plotly.graph_objects as go
     if perc:
         suffix="%"
     else:
@@ -149,11 +216,139 @@ def plot_gauge(value, color, limit_down=0, limit_up=10, perc=False, title="Volte
     return fig
 
 
+########## RENDER CACHE
+class RenderCache:
+    """
+    LRU cache of rendered charts (PNG/SVG bytes or plotly figures), bounded by the total size of
+    the stored values. Shared by the sessions of a worker, so it is guarded by a lock.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None):
+        """Stores `value`; `size` in bytes defaults to len(value)."""
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'items': len(self._items), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+render_cache = RenderCache()
+
+
+def _content_key(*parts):
+    """
+    Hash of the content of the chart inputs (pd.Series are hashed on index, values and name,
+    pd.DataFrame on index, columns and values).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            h.update(repr((part.index.tolist(), part.columns.tolist())).encode())
+            h.update(np.ascontiguousarray(part.to_numpy(dtype=np.float64)).tobytes())
+        elif isinstance(part, pd.Series):
+            h.update(repr((part.name, part.index.tolist())).encode())
+            h.update(np.ascontiguousarray(part.to_numpy(dtype=np.float64)).tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b'|')
+    return h.hexdigest()
+
+
+def figure_to_bytes(fig, fmt='png'):
+    """Rasterizes (or vectorizes) a matplotlib figure like st.pyplot does."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, dpi=200, bbox_inches='tight')
+    return buffer.getvalue()
+
+
+def chart_key(series_list, order, title, figsize=(6, 6), labels=None, show_legend=True, show_title=True,
+              fmt='png', theme=DEFAULT_THEME):
+    """Key of render_horizontal_bar_chart(...) in the render cache and in a ResultStore."""
+    series = [series_list] if isinstance(series_list, pd.DataFrame) else series_list
+    return _content_key('hbar', *series, order, title, figsize, labels, show_legend, show_title,
+                        list(theme.colors), fmt)
+
+
+def render_horizontal_bar_chart(series_list, order, title, figsize=(6, 6), labels=None,
+                                show_legend=True, show_title=True, fmt='png', store=None, theme=DEFAULT_THEME):
+    """
+    plot_horizontal_bar_chart rendered to PNG/SVG bytes, cached on the content of the inputs.
+    The figure is closed as soon as it is rendered.
+
+    :param store: Optional utils_store.ResultStore of charts rendered ahead of time, looked up
+                  before rendering.
+    """
+    key = chart_key(series_list, order, title, figsize, labels, show_legend, show_title, fmt, theme)
+    image = render_cache.get(key)
+    if image is None:
+        image = store.get_chart(key, fmt) if store is not None else None
+        if image is None:
+            fig = plot_horizontal_bar_chart(series_list, order, title, figsize=figsize, labels=labels,
+                                            show_legend=show_legend, show_title=show_title, theme=theme)
+            image = figure_to_bytes(fig, fmt)
+        render_cache.put(key, image)
+    return image
+
+
+def gauge_key(value, color, limit_down=0, limit_up=10, perc=False, title="Volte al mese", fmt=None):
+    """Key of render_gauge(...) in the render cache (`fmt` for a gauge exported to an image)."""
+    parts = ('gauge', float(value), color, limit_down, limit_up, perc, title)
+    return _content_key(*parts) if fmt is None else _content_key(*parts, fmt)
+
+
+def render_gauge(value, color, limit_down=0, limit_up=10, perc=False, title="Volte al mese"):
+    """
+    plot_gauge cached on its inputs. The figure itself is cached, sized by its JSON: rebuilding
+    it from JSON would cost more than building it again. Callers must not modify it.
+    """
+    key = gauge_key(value, color, limit_down, limit_up, perc, title)
+    fig = render_cache.get(key)
+    if fig is None:
+        fig = plot_gauge(value, color, limit_down=limit_down, limit_up=limit_up, perc=perc, title=title)
+        render_cache.put(key, fig, size=len(fig.to_json()))
+    return fig
+
+
 ################## PLOTLY
 def make_bars_plotly_all(input_color, s: pd.Series, 
                          fixed_order_flag_freq=False, fixed_order_flag_camb=False,
                          horizontale=True,
                          width=800, height=600):
+    import plotly.graph_objects as go
     color_map = {
         'blue': BLUE,
         'cyan': CYAN,
@@ -232,6 +427,7 @@ def make_bars_plotly_all(input_color, s: pd.Series,
     return fig
 
 def make_bars_plotly(input_color, s: pd.Series, width=800, height=600):
+    import plotly.graph_objects as go
     if len(s.index.levels[0]) == 2:
         height *= 1.1
     if len(s.index.levels[0]) == 3:
@@ -247,8 +443,9 @@ def make_bars_plotly(input_color, s: pd.Series, width=800, height=600):
         ][::-1]
         new_categories = pd.Categorical(s.index.get_level_values(1), categories=fixed_order, ordered=True)
 
-        # Rebuild the MultiIndex with the new categorical order for the second level
-        s.index = pd.MultiIndex.from_arrays([s.index.get_level_values(0), new_categories], names=s.index.names)
+        # Rebuild the MultiIndex with the new categorical order for the second level (on a new
+        # Series: the caller's one may be shared with other sessions)
+        s = s.set_axis(pd.MultiIndex.from_arrays([s.index.get_level_values(0), new_categories], names=s.index.names))
 
         # Sort the Series based on the new index
         s = s.sort_index(level=1)
@@ -262,8 +459,9 @@ def make_bars_plotly(input_color, s: pd.Series, width=800, height=600):
 
         new_categories = pd.Categorical(s.index.get_level_values(1), categories=fixed_order, ordered=True)
 
-        # Rebuild the MultiIndex with the new categorical order for the second level
-        s.index = pd.MultiIndex.from_arrays([s.index.get_level_values(0), new_categories], names=s.index.names)
+        # Rebuild the MultiIndex with the new categorical order for the second level (on a new
+        # Series: the caller's one may be shared with other sessions)
+        s = s.set_axis(pd.MultiIndex.from_arrays([s.index.get_level_values(0), new_categories], names=s.index.names))
 
         # Sort the Series based on the new index
         s = s.sort_index(level=1)
@@ -0,0 +1,443 @@
+"""
+Store of query results and charts, on disk next to the data: filled ahead of time by `warm`, then
+read and written by every dashboard worker of the machine, and kept across restarts.
+
+    python utils_store.py warm [--render] [--products default|each] [--workers N] [--engine cube]
+    python utils_store.py stats
+
+`warm` enumerates the sidebar selections found in the data (countries alone or compared two by
+two, Italian regions alone or compared two by two, times every sesso, generazione and res_acq),
+computes the queries of the page for each of them over a process pool and writes the results,
+and with --render the PNG charts, to the store next to the data (data/stili_al.store/). It then
+prints the number of combinations, the total time and the throughput as JSON.
+"""
+import os
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+import itertools
+from utils_data import DATA_PATH, file_version, atomic_write
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = int(os.environ.get('STILI_STORE_MAX_MB', 512)) * 2**20  # results kept in the store
+LOCK_TIMEOUT = 30.0  # seconds a writer waits for the others
+FLUSH_EVERY = 64     # lookups counted in the process before they are written to the store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    version TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (version, key)
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0), ('bytes', 0);
+"""
+
+
+def store_path(path=DATA_PATH):
+    """Directory of the store of the survey csv at `path` ($STILI_STORE_DIR if set, e.g. a local disk)."""
+    return os.environ.get('STILI_STORE_DIR') or os.path.splitext(os.path.abspath(path))[0] + '.store'
+
+
+def _version_dir(version):
+    return 'v{}_{}'.format(*version)
+
+
+class ResultStore:
+    """
+    Store of precomputed values, shared by every process on the machine and kept across restarts:
+    - results.sqlite: pickled query results (see utils_engine.query_key), each only valid for the
+      version of the data it was computed on. Every worker reads and writes it concurrently
+      (SQLite in WAL mode: readers never block, writers take turns); past `max_bytes` the least
+      recently used results are evicted. The hits and misses of all the processes are counted in
+      it too (see stats);
+    - charts/<content key>.<fmt>: rendered charts (see utils_plot.chart_key), whose key already
+      depends on the data drawn.
+    """
+
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.db = os.path.join(root, 'results.sqlite')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # lookups not written to the database yet: counters and last use of the results read
+        self._pending = {'hits': 0, 'misses': 0, 'used': {}}
+        self.hits = self.misses = self.writes = self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        """Connection of the calling thread (sqlite3 connections are not shared between threads)."""
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.db, timeout=LOCK_TIMEOUT, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con, self._local.pid = con, os.getpid()
+        return con
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    @staticmethod
+    def _key(key):
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    def get(self, version, key, record=True):
+        """
+        The stored result of `key` for the data `version` (None if there is none).
+
+        :param record: Whether the lookup counts in the hits and misses (and in the last use of the
+                       result, for the eviction).
+        """
+        digest = self._key(key)
+        try:
+            row = self._connection().execute('SELECT value FROM results WHERE version = ? AND key = ?',
+                                              (_version_dir(version), digest)).fetchone()
+            value = pickle.loads(row[0]) if row is not None else None
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            logger.warning("result store %s: read failed (%s)", self.db, e)
+            value = None
+        if record:
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                    self._pending['misses'] += 1
+                else:
+                    self.hits += 1
+                    self._pending['hits'] += 1
+                    self._pending['used'][(_version_dir(version), digest)] = time.time()
+                flush = self._pending['hits'] + self._pending['misses'] >= FLUSH_EVERY
+            if flush:
+                self.flush()
+        return value
+
+    def has(self, version, key):
+        try:
+            return self._connection().execute('SELECT 1 FROM results WHERE version = ? AND key = ?',
+                                               (_version_dir(version), self._key(key))).fetchone() is not None
+        except sqlite3.Error:
+            return False
+
+    def put(self, version, key, value):
+        """Stores the result of `key` for the data `version`, evicting the least recently used past max_bytes."""
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            with self._transaction() as con:
+                self._write_pending(con)
+                row = con.execute('SELECT size FROM results WHERE version = ? AND key = ?',
+                                  (_version_dir(version), self._key(key))).fetchone()
+                con.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                            (_version_dir(version), self._key(key), data, len(data), time.time()))
+                con.execute("UPDATE counters SET value = value + ? WHERE name = 'bytes'",
+                            (len(data) - (row[0] if row else 0),))
+                evicted = self._evict(con)
+        except sqlite3.Error as e:
+            # the store only saves work: a busy or read-only database must not fail the query
+            logger.warning("result store %s: write failed (%s)", self.db, e)
+            return
+        with self._lock:
+            self.writes += 1
+            self.evictions += evicted
+
+    def _evict(self, con):
+        """Deletes the least recently used results until they fit in max_bytes; returns their number."""
+        size = con.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0]
+        if size > self.max_bytes:
+            # count the stored results again before evicting any: the counter may have drifted
+            # above them (e.g. rows deleted by hand)
+            size = con.execute('SELECT coalesce(sum(size), 0) FROM results').fetchone()[0]
+        evicted = 0
+        while size > self.max_bytes:
+            rows = con.execute('SELECT version, key, size FROM results ORDER BY used LIMIT 64').fetchall()
+            if not rows:  # max_bytes < 0
+                break
+            for version, key, n in rows:
+                if size <= self.max_bytes:
+                    break
+                con.execute('DELETE FROM results WHERE version = ? AND key = ?', (version, key))
+                size -= n
+                evicted += 1
+        if evicted:
+            con.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'", (evicted,))
+        con.execute("UPDATE counters SET value = ? WHERE name = 'bytes'", (size,))
+        return evicted
+
+    def _write_pending(self, con):
+        """Writes the pending lookups (in the transaction of `con`)."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {'hits': 0, 'misses': 0, 'used': {}}
+        con.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                        [(pending['hits'], 'hits'), (pending['misses'], 'misses')])
+        con.executemany('UPDATE results SET used = max(used, ?) WHERE version = ? AND key = ?',
+                        [(used, version, key) for (version, key), used in pending['used'].items()])
+
+    def flush(self):
+        """Writes the counters and last uses of the lookups made since the last write."""
+        try:
+            with self._transaction() as con:
+                self._write_pending(con)
+        except sqlite3.Error as e:
+            logger.warning("result store %s: flush failed (%s)", self.db, e)
+
+    def get_chart(self, key, fmt='png'):
+        try:
+            with open(os.path.join(self.root, 'charts', f'{key}.{fmt}'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def has_chart(self, key, fmt='png'):
+        return os.path.exists(os.path.join(self.root, 'charts', f'{key}.{fmt}'))
+
+    def put_chart(self, key, image, fmt='png'):
+        os.makedirs(os.path.join(self.root, 'charts'), exist_ok=True)
+        atomic_write(os.path.join(self.root, 'charts', f'{key}.{fmt}'), image)
+
+    def prune(self, version):
+        """Removes the results of the data versions other than `version`."""
+        with self._transaction() as con:
+            con.execute('DELETE FROM results WHERE version != ?', (_version_dir(version),))
+            con.execute("UPDATE counters SET value = (SELECT coalesce(sum(size), 0) FROM results) "
+                        "WHERE name = 'bytes'")
+        # the former store layout: one pickle file per result
+        shutil.rmtree(os.path.join(self.root, 'results'), ignore_errors=True)
+
+    def stats(self):
+        """
+        Results in the store and lookups of all the processes since it was created (`results`), of
+        this process (`process`), and files and bytes on disk.
+        """
+        self.flush()
+        con = self._connection()
+        entries = con.execute('SELECT count(*) FROM results').fetchone()[0]
+        counters = dict(con.execute('SELECT name, value FROM counters').fetchall())
+        lookups = counters['hits'] + counters['misses']
+        files, disk = 0, 0
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                files += 1
+                disk += os.path.getsize(os.path.join(folder, name))
+        with self._lock:
+            process_lookups = self.hits + self.misses
+            process = {'hits': self.hits, 'misses': self.misses, 'writes': self.writes, 'evictions': self.evictions,
+                       'hit_rate': self.hits / process_lookups if process_lookups else 0.0}
+        return {'root': self.root, 'files': files, 'bytes': disk,
+                'results': {'entries': entries, 'bytes': counters['bytes'], 'max_bytes': self.max_bytes,
+                            'hits': counters['hits'], 'misses': counters['misses'],
+                            'hit_rate': counters['hits'] / lookups if lookups else 0.0,
+                            'evictions': counters['evictions']},
+                'process': process}
+
+
+class _Transaction:
+    """`with` block of an immediate (write) transaction on `con`, committed at the end."""
+
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        # takes the write lock now: writers wait for each other up to LOCK_TIMEOUT instead of
+        # failing on a lock upgrade
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        self.con.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path=DATA_PATH, create=False):
+    """
+    The store of the survey csv at `path`, opened once per process; None if it was never warmed,
+    unless `create` (or if it cannot be opened, e.g. on a read-only data directory).
+    """
+    root = store_path(path)
+    with _stores_lock:
+        if root not in _stores:
+            if not create and not os.path.isdir(root):
+                return None
+            try:
+                _stores[root] = ResultStore(root)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("result store %s not available (%s)", root, e)
+                return None
+        return _stores[root]
+
+
+#######################
+# Warm up
+def filter_space(options):
+    """
+    Sidebar selections (make_filters arguments) found in the data: every location (all countries,
+    a country, two countries compared, an Italian region, two regions compared) with every
+    sesso, generazione and res_acq (or 'All').
+    """
+    countries, regions = options['country'], options['regione']
+    locations = [('All', (), 'All', ())]
+    locations += [(country, (), 'All', ()) for country in countries]
+    locations += [(a, (b,), 'All', ()) for a, b in itertools.combinations(countries, 2)]
+    locations += [('Italia', (), region, ()) for region in regions]
+    locations += [('Italia', (), a, (b,)) for a, b in itertools.combinations(regions, 2)]
+    demographics = itertools.product(['All'] + options['sesso'], ['All'] + options['generazione'],
+                                     ['All'] + options['res_acq'])
+    return [location + demographic for location, demographic in itertools.product(locations, list(demographics))]
+
+
+_worker = {}
+
+
+def _init_worker(name, path, root, render, products):
+    from utils_engine import load_engine
+    if render:
+        import matplotlib
+        matplotlib.use('Agg')
+    _worker.update(engine=load_engine(name, path), name=name, version=file_version(path),
+                   store=ResultStore(root), render=render, products=products)
+
+
+def _warm(selections):
+    """Computes and stores the results (and charts) of `selections`; returns (results, charts) written."""
+    from utils_agg import make_filters
+    from utils_engine import query_key
+    engine, name, version, store = _worker['engine'], _worker['name'], _worker['version'], _worker['store']
+    n_results = n_charts = 0
+    for selection in selections:
+        filters, compare_by = make_filters(*selection)
+        # the queries of dashboard.py, with the same arguments
+        queries = [('stile_matrix', (compare_by,)) if compare_by else ('stile_counts', ()),
+                   ('category_table', (('regione', 'sesso', 'generazione'),)),
+                   ('product_stats', ())]
+        results = {}
+        for method, args in queries:
+            key = query_key(name, method, filters, *args)
+            value = store.get(version, key, record=False)
+            if value is None:
+                value = getattr(engine, method)(filters, *args)
+                store.put(version, key, value)
+                n_results += 1
+            results[method] = value
+        if _worker['render']:
+            n_charts += _render(store, results, compare_by)
+    return n_results, n_charts
+
+
+def _render(store, results, compare_by):
+    """Renders and stores the bar charts of a selection; returns the number of charts written."""
+    from utils_contstants import food, order_stile, order_frequenza, order_cambiamento
+    from utils_plot import chart_key, plot_horizontal_bar_chart, figure_to_bytes
+    # the bar charts of dashboard.py, with the same arguments (the key depends on all of them)
+    if compare_by is None:
+        charts = [([results['stile_counts']], order_stile, 'Stili alimentari',
+                   dict(show_legend=False, show_title=False, figsize=(10, 5)))]
+    else:
+        matrix = results['stile_matrix']
+        charts = [(matrix, order_stile, 'Stili alimentari',
+                   dict(show_title=False, labels=list(matrix.index), figsize=(10, 5)))]
+    stats = results['product_stats']
+    selections = [[list(food)[0]]] if _worker['products'] == 'default' else [[product] for product in food]
+    for selected_food in selections:
+        charts.append(([stats['frequenza'][p] for p in selected_food], order_frequenza, "Frequenza",
+                       dict(labels=selected_food, figsize=(6, 3))))
+        charts.append(([stats['cambiamento'][p] for p in selected_food], order_cambiamento, "Cambiamento",
+                       dict(labels=selected_food, figsize=(6, 3))))
+    written = 0
+    for series_list, order, title, kwargs in charts:
+        key = chart_key(series_list, order, title, **kwargs)
+        if not store.has_chart(key):
+            store.put_chart(key, figure_to_bytes(plot_horizontal_bar_chart(series_list, order, title, **kwargs)))
+            written += 1
+    return written
+
+
+def warm(name=None, path=DATA_PATH, workers=None, render=False, products='default', chunk_size=20,
+         progress=None):
+    """
+    Fills the store of `path` with the results (and with `render` the charts) of every selection
+    of filter_space, over a pool of `workers` processes (default: all the cores).
+
+    :param products: 'default' renders the product charts of the default selection only, 'each'
+                     those of every product on its own.
+    :param progress: Optional callable(done, total) called as the chunks complete.
+    :return: Report with the number of combinations, results and charts written, time and throughput.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from utils_engine import ENGINE, load_engine
+    name = name or ENGINE
+    path = os.path.abspath(path)
+    root = store_path(path)
+    version = file_version(path)
+    store = ResultStore(root)
+    os.makedirs(root, exist_ok=True)
+    store.prune(version)
+
+    start = time.perf_counter()
+    selections = filter_space(load_engine(name, path).options)
+    chunks = [selections[i:i + chunk_size] for i in range(0, len(selections), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+    n_results = n_charts = done = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(name, path, root, render, products)) as pool:
+        futures = {pool.submit(_warm, chunk): len(chunk) for chunk in chunks}
+        for future in as_completed(futures):
+            results, charts = future.result()
+            n_results += results
+            n_charts += charts
+            done += futures[future]
+            if progress is not None:
+                progress(done, len(selections))
+    seconds = time.perf_counter() - start
+    report = {
+        'engine': name,
+        'version': list(version),
+        'workers': workers,
+        'combinations': len(selections),
+        'results_written': n_results,
+        'charts_written': n_charts,
+        'seconds': round(seconds, 2),
+        'combinations_per_second': round(len(selections) / seconds, 1),
+        'store': store.stats(),
+    }
+    logger.info("warmed %s: %d combinations in %.1f s", root, len(selections), seconds)
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['warm', 'stats'])
+    parser.add_argument('--path', default=DATA_PATH, help="csv file")
+    parser.add_argument('--engine', default=None, help="engine computing the results (default: $STILI_ENGINE)")
+    parser.add_argument('--workers', type=int, default=None, help="processes (default: all the cores)")
+    parser.add_argument('--render', action='store_true', help="also render the bar charts")
+    parser.add_argument('--products', choices=['default', 'each'], default='default',
+                        help="product charts to render: default selection only or every product")
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        store = open_store(args.path)
+        print(json.dumps(store.stats() if store else None, indent=2))
+    else:
+        def progress(done, total):
+            print(f"\r{done}/{total} combinations", end='', file=sys.stderr, flush=True)
+
+        report = warm(args.engine, args.path, args.workers, args.render, args.products, progress=progress)
+        print(file=sys.stderr)
+        print(json.dumps(report, indent=2))
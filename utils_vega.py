@@ -0,0 +1,114 @@
+"""
+Vega-Lite versions of the dashboard charts, built as plain dicts straight from the aggregated
+series: no matplotlib or plotly import, no rasterization on the server (st.vega_lite_chart
+sends the spec, the browser draws it).
+"""
+import math
+from utils_contstants import COLORS, GREY
+from utils_plot import bar_widths, bar_percentages, series_labels
+
+SCHEMA = 'https://vega.github.io/schema/vega-lite/v5.json'
+
+
+def _px(points):
+    """matplotlib font sizes are in points, Vega-Lite ones in pixels."""
+    return round(points * 4 / 3, 1)
+
+
+def vega_horizontal_bar_chart(series_list, order, title, figsize=(6, 6), labels=None,
+                              show_legend=True, show_title=True, colors=COLORS):
+    """
+    Vega-Lite spec of plot_horizontal_bar_chart: same bar order, colors, percentage labels
+    (inside the bar in white when wider than 90, outside in black otherwise) and label font sizes.
+
+    :param series_list: List of pd.Series to plot, or a pd.DataFrame with one row per series.
+    :param order: The order of the bars on the y-axis (first one at the bottom).
+    :param title: The title of the plot.
+    :param labels: Optional list of labels for the series.
+    """
+    n = len(series_list)
+    perc_fontsize = {1: 10, 2: 5, 3: 3}.get(n, 1)
+    labels = [str(label) for label in series_labels(series_list, labels)[:n]]
+
+    widths = bar_widths(series_list, order)
+    percentages = bar_percentages(widths)
+
+    values = [
+        {'category': category, 'series': label, 'value': float(widths[i, j]),
+         'percentage': f"{percentages[i, j]:.1f}%"}
+        for i, label in enumerate(labels)
+        for j, category in enumerate(order)
+    ]
+
+    def text_layer(test, align, dx, color):
+        return {
+            'transform': [{'filter': test}],
+            'mark': {'type': 'text', 'align': align, 'baseline': 'middle', 'dx': dx,
+                     'color': color, 'fontSize': _px(perc_fontsize)},
+            'encoding': {'text': {'field': 'percentage'}},
+        }
+
+    spec = {
+        '$schema': SCHEMA,
+        'data': {'values': values},
+        'width': 'container',
+        'height': int(figsize[1] * 60),
+        'encoding': {
+            # matplotlib draws the first category (and the first series) at the bottom
+            'y': {'field': 'category', 'type': 'nominal', 'sort': list(order)[::-1], 'title': None,
+                  'scale': {'paddingInner': 0.2},
+                  'axis': {'labelFontSize': _px(9), 'labelPadding': 5, 'ticks': False, 'domainWidth': 1.1}},
+            'yOffset': {'field': 'series', 'sort': labels[::-1]},
+            'x': {'field': 'value', 'type': 'quantitative', 'title': None,
+                  'axis': {'orient': 'top', 'labelFontSize': _px(11), 'ticks': False, 'domain': False,
+                           'gridColor': GREY, 'gridOpacity': 0.6}},
+        },
+        'layer': [
+            {
+                'mark': {'type': 'bar'},
+                'encoding': {'color': {
+                    'field': 'series', 'type': 'nominal',
+                    'scale': {'domain': labels, 'range': [colors[i % len(colors)] for i in range(n)]},
+                    'legend': {'title': None} if show_legend else None,
+                }},
+            },
+            text_layer('datum.value > 90', 'right', -3, 'white'),
+            text_layer('datum.value <= 90', 'left', 3, 'black'),
+        ],
+        'config': {'view': {'stroke': None}},
+    }
+    if show_title:
+        spec['title'] = {'text': title, 'fontSize': _px(20)}
+    return spec
+
+
+def vega_gauge(value, color, limit_down=0, limit_up=10, perc=False, title="Volte al mese"):
+    """Vega-Lite spec of plot_gauge: a half-circle gauge with the value in the middle."""
+    suffix = "%" if perc else ""
+    # clamped like the plotly gauge: +inf (growth from a zero baseline) fills it, nan leaves it empty
+    clamped = min(max(value, limit_down), limit_up)
+    fraction = (clamped - limit_down) / (limit_up - limit_down) if math.isfinite(clamped) else 0.0
+    start = 1.5 * math.pi  # 9 o'clock (the schema wants non negative angles)
+
+    def arc(theta2, arc_color, radius, radius2):
+        return {'mark': {'type': 'arc', 'theta': start, 'theta2': theta2, 'radius': radius,
+                         'radius2': radius2, 'color': arc_color}}
+
+    def text(content, size, dy, dx=0):
+        return {'mark': {'type': 'text', 'text': content, 'fontSize': size, 'dx': dx, 'dy': dy}}
+
+    return {
+        '$schema': SCHEMA,
+        'data': {'values': [{}]},
+        'width': 150,
+        'height': 170,
+        'layer': [
+            arc(2.5 * math.pi, '#eeeeee', 65, 35),
+            arc(start + fraction * math.pi, color, 58, 42),
+            text(f"{value:.1f}{suffix}" if math.isfinite(value) else str(value), 28, -12),
+            text(title, 12, -80),
+            text(f"{limit_down:g}", 10, 12, dx=-50),
+            text(f"{limit_up:g}", 10, 12, dx=50),
+        ],
+        'config': {'view': {'stroke': None}},
+    }